@@ -118,10 +118,23 @@ def minCutPatch(patch, block_size, overlap, res, y, x):
 
     return patch
 
+#Load the 8-bit pixels of a wrinkle texture, converted to a float image by texture_as_float
+def read_texture(image_path):
+    return np.asarray(Image.open(image_path))
+
+def texture_as_float(texture):
+    return util.img_as_float(texture)
+
+#Load a wrinkle texture as a float image
+def load_texture(image_path):
+    return texture_as_float(read_texture(image_path))
+
 #Main function for image quilting
 def quilt(image_path, block_size, num_block, mode, sequence=False):
-    texture = Image.open(image_path)
-    texture = util.img_as_float(texture)
+    return quilt_texture(load_texture(image_path), block_size, num_block, mode, sequence)
+
+#Image quilting from an already loaded texture
+def quilt_texture(texture, block_size, num_block, mode, sequence=False):
     overlap = block_size // 6
     num_blockHigh, num_blockWide = num_block
 
@@ -246,19 +259,31 @@ def getCoords(angle,n,hh,ww):
     return coords1,coords2
 
 #Main fnction to apply wrinkles and creases
-def get_creased(input_file,output_directory,ifWrinkles=False,ifCreases=False,crease_angle=0,num_creases_vertically=3,num_creases_horizontally=2,bbox=False):
+def get_creased(input_file,output_directory,ifWrinkles=False,ifCreases=False,crease_angle=0,num_creases_vertically=3,num_creases_horizontally=2,bbox=False,wrinkle_textures=None):
     filename = input_file
+    img = cv2.imread(filename)
+    img = apply_creases(img[:,:,::-1],ifWrinkles=ifWrinkles,ifCreases=ifCreases,crease_angle=crease_angle,num_creases_vertically=num_creases_vertically,num_creases_horizontally=num_creases_horizontally,wrinkle_textures=wrinkle_textures)
+
+    # save results
+    cv2.imwrite(filename, img[:,:,::-1])
+    
+    return filename
 
+#Apply wrinkles and creases to an image held in memory, returns the RGB image as an array
+def apply_creases(image,ifWrinkles=False,ifCreases=False,crease_angle=0,num_creases_vertically=3,num_creases_horizontally=2,wrinkle_textures=None):
     if(ifWrinkles):
     #Seed with a different selection of a wrinkle image
     # read wrinkle image as grayscale and convert to float in range 0 to 1
-        wrinkle_file_name = os.path.join(os.path.join('CreasesWrinkles','wrinkles-dataset') , random.choice(os.listdir(os.path.join('CreasesWrinkles','wrinkles-dataset'))))
-        wrinklesImg = quilt(wrinkle_file_name,250,(1,1),'Cut')
+        if wrinkle_textures is None:
+            wrinkle_file_name = os.path.join(os.path.join('CreasesWrinkles','wrinkles-dataset') , random.choice(os.listdir(os.path.join('CreasesWrinkles','wrinkles-dataset'))))
+            wrinklesImg = quilt(wrinkle_file_name,250,(1,1),'Cut')
+        else:
+            wrinklesImg = quilt_texture(random.choice(wrinkle_textures),250,(1,1),'Cut')
         wrinklesImg=cv2.cvtColor(wrinklesImg, cv2.COLOR_BGR2GRAY)
         wrinklesImg = wrinklesImg.astype("float32") / 255.0
 
-    img_path = filename
-    img = cv2.imread(img_path).astype("float32") / 255.0
+    #Work in BGR order on the colour channels, as read by cv2
+    img = np.ascontiguousarray(image[:,:,2::-1]).astype("float32") / 255.0
     
     hh, ww = img.shape[:2]
 
@@ -337,8 +362,5 @@ def get_creased(input_file,output_directory,ifWrinkles=False,ifCreases=False,cre
 
     img = ( 255 * img ).clip(0, 255).astype(np.uint8)
    
-    # save results
-    cv2.imwrite(filename, img)
-    
-    return filename
+    return np.ascontiguousarray(img[:,:,::-1])
     
\ No newline at end of file
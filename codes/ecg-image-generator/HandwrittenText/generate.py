@@ -1,4 +1,5 @@
 import pickle
+import io
 import argparse
 import numpy as np
 import pandas as pd
@@ -138,13 +139,8 @@ def sample_text(sess, args_text, translation, force,bias,style=None):
 
     return phi_data, window_data, kappa_data, stroke_data, coords
 
-#Main function to add handwritten text to ecg
-def get_handwritten(link,num_words,input_file,output_dir,x_offset=0,y_offset=0,handwriting_size_factor=0.2,model_path=os.path.join(os.path.join('HandwrittenText','pretrained'), 'model-29'),text=None,style=None,bias=1.,force=False,animation=False,noinfo=True,save=None,bbox= False):
-    #Use 'Agg' mode to prevent accumulation of figures
-    matplotlib.use("Agg")
-    filename = input_file
-    
-    #Extract n medical terms
+#Extract medical terms from a URL or a text file
+def get_medical_entities(link):
     if(validators.url(link)):
         #Parse URL
         r = requests.get(link)
@@ -174,24 +170,56 @@ def get_handwritten(link,num_words,input_file,output_dir,x_offset=0,y_offset=0,h
             #Extract medical terms using biomedical library
         nlp = spacy.load("en_core_sci_sm")
         doc = nlp(text)
-        #Choose n random words from the extracted list
-    words = random.choices(doc.ents,k=num_words)
+    return doc.ents
 
-        #Load the pretrained RNN model for handwritten text generation
+#Load the pretrained RNN model for handwritten text generation into its own graph and session
+def load_handwriting_model(model_path=os.path.join(os.path.join('HandwrittenText','pretrained'), 'model-29')):
     with open(os.path.join(os.path.join('HandwrittenText','data'), 'translation.pkl'), 'rb') as file:
         translation = pickle.load(file)
-    rev_translation = {v: k for k, v in translation.items()}
-    charset = [rev_translation[i] for i in range(len(rev_translation))]
-    charset[0] = ''
 
     #Configure machine
     config = tf.compat.v1.ConfigProto(
         device_count={'GPU': 0}
     )
-    #Create session 
-    with tf.compat.v1.Session(config=config) as sess:
+    graph = tf.Graph()
+    with graph.as_default():
+        sess = tf.compat.v1.Session(config=config, graph=graph)
         saver = tf.compat.v1.train.import_meta_graph(model_path + '.meta')
         saver.restore(sess, model_path)
+    return sess, translation
+
+#Main function to add handwritten text to ecg
+def get_handwritten(link,num_words,input_file,output_dir,x_offset=0,y_offset=0,handwriting_size_factor=0.2,model_path=os.path.join(os.path.join('HandwrittenText','pretrained'), 'model-29'),text=None,style=None,bias=1.,force=False,animation=False,noinfo=True,save=None,bbox= False,entities=None,handwriting_model=None):
+    filename = input_file
+    #Load the ecg image
+    img_ecg = np.array(Image.open(filename))
+    img_final = add_handwritten_text(img_ecg,link,num_words,x_offset=x_offset,y_offset=y_offset,handwriting_size_factor=handwriting_size_factor,model_path=model_path,bias=bias,force=force,entities=entities,handwriting_model=handwriting_model)
+    #Save final image
+    head, tail = os.path.split(filename)
+    outfile = os.path.join(output_dir,tail)
+    Image.fromarray(img_final).save(outfile)
+    return outfile
+
+#Add handwritten text to an ecg image held in memory, returns the RGB image as an array
+def add_handwritten_text(image,link,num_words,x_offset=0,y_offset=0,handwriting_size_factor=0.2,model_path=os.path.join(os.path.join('HandwrittenText','pretrained'), 'model-29'),bias=1.,force=False,entities=None,handwriting_model=None):
+    #Use 'Agg' mode to prevent accumulation of figures
+    matplotlib.use("Agg")
+    
+    #Extract n medical terms, unless they were already extracted by the caller
+    if entities is None:
+        entities = get_medical_entities(link)
+    #Choose n random words from the extracted list
+    words = random.choices(entities,k=num_words)
+
+    #Reuse the session opened by the caller, or load the model for this call only
+    if handwriting_model is None:
+        sess, translation = load_handwriting_model(model_path)
+        close_session = True
+    else:
+        sess, translation = handwriting_model
+        close_session = False
+
+    with sess.graph.as_default():
         #Generate n handwritten words from the selected words
         numw = len(words)
         fig, ax = plt.subplots(numw, 1)
@@ -219,18 +247,15 @@ def get_handwritten(link,num_words,input_file,output_dir,x_offset=0,y_offset=0,h
             ax[i].set_aspect('equal')
             ax[i].set_axis_off()
             i=i+1
-            #Save the plot as HandwrittenText.png
-        fig.savefig('HandwrittenText.png',dpi=1200)
-        img_path = filename
-        file_head,file_tail = os.path.splitext(filename)
-        boxed_file = file_head + '-boxed' + file_tail
+        #Render the handwritten text in memory, so that parallel workers sharing a working directory do not clash
+        buffer = io.BytesIO()
+        fig.savefig(buffer,format='png',dpi=1200)
+        buffer.seek(0)
                 
-        #Load the ecg image
-        img_ecg = Image.open(img_path)
         #Convert from RGBA to RGB
-        img_ecg = img_ecg.convert('RGB')
+        img_ecg = Image.fromarray(image).convert('RGB')
         #Load the generated handwritten text image
-        img_handwritten = Image.open('HandwrittenText.png')
+        img_handwritten = Image.open(buffer)
         #Convert the generated handwritten text image to RGB
         img_handwritten = img_handwritten.convert('RGB')
         #Resize the handwritten text image
@@ -250,17 +275,12 @@ def get_handwritten(link,num_words,input_file,output_dir,x_offset=0,y_offset=0,h
         img_cropped = img_ecg[x_offset:img_handwritten.shape[0]+x_offset,y_offset:img_handwritten.shape[1]+y_offset,:img_handwritten.shape[2]] * img_handwritten
         #Apply cropped image
         img_ecg[x_offset:img_handwritten.shape[0]+x_offset,y_offset:img_handwritten.shape[1]+y_offset,:img_handwritten.shape[2]] = img_cropped
-        #Save final image
-        img_final = Image.fromarray(img_ecg)
-        head, tail = os.path.split(filename)
-        img_final.save(os.path.join(output_dir,tail))
 
-        #Load the ecg image
         plt.close('all')
         plt.close(fig)
         plt.clf()
         plt.cla()
         
-        os.remove('HandwrittenText.png')
-        outfile = os.path.join(output_dir,tail)
-        return outfile
+        if close_session:
+            sess.close()
+        return img_ecg
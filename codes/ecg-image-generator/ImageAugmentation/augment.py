@@ -33,12 +33,25 @@ def get_augment(input_file,output_directory,rotate=25,noise=25,crop=0.01,tempera
     image = Image.open(filename)
     
     image = np.array(image)
-    
+
+    image_aug = augment_image(image,rotate=rotate,noise=noise,crop=crop,temperature=temperature,bbox=bbox,store_text_bounding_box=store_text_bounding_box,json_dict=json_dict)
+
+    head, tail = os.path.split(filename)
+
+    f = os.path.join(output_directory,tail)
+    plt.imsave(fname=f,arr=image_aug)
+
+    return f
+
+# Run the augmentations on an image held in memory and update the annotations in json_dict, returns the RGB image as an array
+#Annotation layers that are not kept (bbox, store_text_bounding_box, store_plotted_pixels) are neither read nor transformed
+def augment_image(image,rotate=25,noise=25,crop=0.01,temperature=6500,bbox=False, store_text_bounding_box=False, json_dict=None, rot=None, crop_sample=None, store_plotted_pixels=True):
     lead_bbs = []
     leadNames_bbs = []
-    
-         
-    lead_bbs, leadNames_bbs, lead_bbs_labels, startTime_bbs, endTime_bbs, plotted_pixels = read_leads(json_dict['leads'])
+    annotate = bbox or store_text_bounding_box or store_plotted_pixels
+
+    if annotate:
+        lead_bbs, leadNames_bbs, lead_bbs_labels, startTime_bbs, endTime_bbs, plotted_pixels = read_leads(json_dict['leads'])
     
     if bbox:
         lead_bbs = BoundingBoxesOnImage(lead_bbs, shape=image.shape)
@@ -47,8 +60,11 @@ def get_augment(input_file,output_directory,rotate=25,noise=25,crop=0.01,tempera
     
     images = [image[:, :, :3]]
     h, w, _ = image.shape
-    rot = random.randint(-rotate, rotate)
-    crop_sample = random.uniform(0, crop)
+    #The rotation angle and crop fraction are sampled here unless a job plan provides them
+    if rot is None:
+        rot = random.randint(-rotate, rotate)
+    if crop_sample is None:
+        crop_sample = random.uniform(0, crop)
     #Augment in a sequential manner. Create an augmentation object
     seq = iaa.Sequential([
           iaa.Affine(rotate=rot),
@@ -58,6 +74,8 @@ def get_augment(input_file,output_directory,rotate=25,noise=25,crop=0.01,tempera
           ])
     
     images_aug = seq(images=images)
+    if not annotate:
+        return images_aug[0]
 
     if bbox:
         augmented_lead_bbs = rotate_bounding_box(lead_bbs, [h/2,w/2], -rot)
@@ -68,15 +86,12 @@ def get_augment(input_file,output_directory,rotate=25,noise=25,crop=0.01,tempera
     else:
         augmented_leadName_bbs = []   
 
-    rotated_pixel_coordinates = rotate_points(plotted_pixels, [h/2, w/2], -rot)
-
-    if bbox or store_text_bounding_box:
-        json_dict['leads'] = convert_bounding_boxes_to_dict(augmented_lead_bbs, augmented_leadName_bbs, lead_bbs_labels, startTime_bbs, endTime_bbs, rotated_pixel_coordinates)
-
-    head, tail = os.path.split(filename)
+    if store_plotted_pixels:
+        rotated_pixel_coordinates = rotate_points(plotted_pixels, [h/2, w/2], -rot)
+    else:
+        rotated_pixel_coordinates = None
 
-    f = os.path.join(output_directory,tail)
-    plt.imsave(fname=f,arr=images_aug[0])
+    json_dict['leads'] = convert_bounding_boxes_to_dict(augmented_lead_bbs, augmented_leadName_bbs, lead_bbs_labels, startTime_bbs, endTime_bbs, rotated_pixel_coordinates)
 
-    return f
+    return images_aug[0]
 
@@ -0,0 +1,147 @@
+import os, sys, argparse, json
+import time
+import shutil
+import tempfile
+import platform
+import warnings
+from helper_functions import iter_records
+from gen_ecg_images_from_data_batch import get_parser as get_batch_parser, run
+from profiling import summarize_stage_timings
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+warnings.filterwarnings("ignore")
+
+# Generator options of every benchmarked configuration
+CONFIGURATIONS = {'plain' : [],
+                  'hw_text' : ['--hw_text'],
+                  'wrinkles' : ['--wrinkles'],
+                  'augment' : ['--augment'],
+                  'fully_random' : ['--fully_random'],
+                  'store_config_2' : ['--store_config', '2', '--lead_bbox', '--lead_name_bbox'],
+                  'resolution_100' : ['-r', '100'],
+                  'resolution_300' : ['-r', '300'],
+                  'resolution_600' : ['-r', '600'],
+                  'png_compression_1' : ['--png_compression', '1'],
+                  'png_compression_9' : ['--png_compression', '9'],
+                  'jpeg_90' : ['--image_format', 'jpeg'],
+                  'webp_90' : ['--image_format', 'webp'],
+                  'npy' : ['--image_format', 'npy'],
+                  'grid_cache' : ['--grid_cache_mb', '256'],
+                  'raster' : ['--renderer', 'raster']
+    }
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_directories', type=str, nargs='+', default=[os.path.join('..', '..', 'sample-data', 'ecg-time-series'), 'SampleData'])
+    parser.add_argument('-o', '--output_file', type=str, default='benchmark_results.json')
+    parser.add_argument('-c', '--configurations', type=str, nargs='+', default=list(CONFIGURATIONS.keys()), choices=list(CONFIGURATIONS.keys()))
+    parser.add_argument('-se', '--seed', type=int, default=10)
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--max_num_images', type=int, default=-1)
+    parser.add_argument('--work_directory', type=str, default=None)
+    parser.add_argument('--baseline', type=str, default=None)
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    return parser
+
+def run_configuration(input_directory, output_directory, options, args):
+    batch_args = get_batch_parser().parse_args(['-i', input_directory, '-o', output_directory,
+                                                '-se', str(args.seed),
+                                                '--num_workers', str(args.num_workers),
+                                                '--max_num_images', str(args.max_num_images),
+                                                '--stage_timings'] + options)
+    start = time.perf_counter()
+    num_images = run(batch_args)
+    seconds = time.perf_counter() - start
+
+    output_bytes = 0
+    for root, directories, files in os.walk(output_directory):
+        for file in files:
+            if os.path.splitext(file)[1] in ('.png', '.jpg', '.jpeg', '.webp', '.npy'):
+                output_bytes += os.path.getsize(os.path.join(root, file))
+
+    stages = summarize_stage_timings(os.path.join(output_directory, 'stage_timings.jsonl'))
+    result = dict()
+    result['images'] = num_images
+    result['seconds'] = round(seconds, 3)
+    result['images_per_sec'] = round(num_images/seconds, 4) if seconds > 0 else 0
+    result['bytes_per_image'] = round(output_bytes/num_images) if num_images > 0 else 0
+    result['peak_rss_mb'] = max([stages[name]['peak_rss_mb']['max'] for name in stages], default=0)
+    result['stages'] = stages
+    return result
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Compare throughput of every configuration with a stored baseline
+
+    Returns:
+        regressions (list): Names of the configurations slower than the baseline by more than tolerance
+    """
+    regressions = []
+    print('{:<36}{:>14}{:>14}{:>10}'.format('configuration', 'baseline img/s', 'current img/s', 'change'))
+    for name in results:
+        if name not in baseline or 'images_per_sec' not in results[name] or 'images_per_sec' not in baseline[name]:
+            continue
+        old = baseline[name]['images_per_sec']
+        new = results[name]['images_per_sec']
+        change = (new - old)/old if old > 0 else 0
+        print('{:<36}{:>14.3f}{:>14.3f}{:>+9.1f}%'.format(name, old, new, 100*change))
+        if change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+def run_benchmark(args):
+    input_directories = [d for d in args.input_directories if os.path.isdir(d) and next(iter_records(d), None) is not None]
+    for d in args.input_directories:
+        if d not in input_directories:
+            print('Skipping {}: no WFDB records found'.format(d))
+    if input_directories == []:
+        raise Exception("None of the benchmark input directories has WFDB compatible ECG files, please re-check the input arguments!")
+
+    work_directory = args.work_directory if args.work_directory is not None else tempfile.mkdtemp(prefix='ecg-benchmark-')
+
+    results = dict()
+    for input_directory in input_directories:
+        dataset = os.path.basename(os.path.normpath(input_directory))
+        for configuration in args.configurations:
+            name = dataset + '/' + configuration
+            output_directory = os.path.join(work_directory, dataset, configuration)
+            if os.path.exists(output_directory):
+                shutil.rmtree(output_directory)
+            print('Running {}'.format(name))
+            try:
+                results[name] = run_configuration(input_directory, output_directory, CONFIGURATIONS[configuration], args)
+            except Exception as e:
+                results[name] = {'error': repr(e)}
+
+    if args.work_directory is None:
+        shutil.rmtree(work_directory)
+
+    report = dict()
+    report['seed'] = args.seed
+    report['num_workers'] = args.num_workers
+    report['platform'] = platform.platform()
+    report['python'] = platform.python_version()
+    report['results'] = results
+    with open(args.output_file, 'w') as f:
+        f.write(json.dumps(report, indent=4))
+
+    print('{:<36}{:>8}{:>10}{:>12}{:>14}'.format('configuration', 'images', 'img/s', 'peak MB', 'bytes/image'))
+    for name in results:
+        if 'error' in results[name]:
+            print('{:<36}  {}'.format(name, results[name]['error']))
+        else:
+            print('{:<36}{:>8}{:>10.3f}{:>12.0f}{:>14}'.format(name, results[name]['images'], results[name]['images_per_sec'], results[name]['peak_rss_mb'], results[name]['bytes_per_image']))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print('Slower than the baseline by more than {:.0f}%: {}'.format(100*args.tolerance, ', '.join(regressions)))
+            return 1
+    return 0
+
+if __name__=='__main__':
+    path = os.path.join(os.getcwd(), sys.argv[0])
+    parentPath = os.path.dirname(path)
+    os.chdir(parentPath)
+    sys.exit(run_benchmark(get_parser().parse_args(sys.argv[1:])))
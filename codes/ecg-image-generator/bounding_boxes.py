@@ -0,0 +1,31 @@
+import numpy as np
+from matplotlib.font_manager import findfont
+from matplotlib.transforms import Bbox
+from font_cache import font_cache
+
+#Window extent of a trace plotted on ax, the transformed minimum and maximum of its samples as matplotlib computes it for lines without markers
+def get_line_extent(ax, x_vals, y_vals):
+    corners = ax.transData.transform([[np.nanmin(x_vals), np.nanmin(y_vals)], [np.nanmax(x_vals), np.nanmax(y_vals)]])
+    return Bbox(corners)
+
+def get_text_extent(ax, text):
+    """Window extent of a text of ax, from the metrics of its string in the font cache
+
+    The layout of a string only depends on its font, size and the resolution, and is
+    translated to the anchor of the text. Each distinct string is therefore laid out
+    by the renderer once, the extents of later texts are their transformed
+    anchor plus the cached offsets.
+
+    Args:
+        ax (Axes): Axes the text was added to
+        text (Text): Text with left and baseline alignment and no rotation
+    Returns:
+        extent (Bbox): Bounding box of the text in display pixels
+    """
+    key = (findfont(text.get_fontproperties()), text.get_fontsize(), ax.figure.dpi, text.get_text())
+    x, y = ax.transData.transform([text.get_position()])[0]
+    def measure():
+        bb = text.get_window_extent()
+        return (bb.x0 - x, bb.y0 - y, bb.x1 - x, bb.y1 - y)
+    x0, y0, x1, y1 = font_cache.get_extent(key, measure)
+    return Bbox([[x + x0, y + y0], [x + x1, y + y1]])
@@ -1,32 +1,18 @@
 import os
 import numpy as np
 import random
-import matplotlib.pyplot as plt
 import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.ticker import AutoMinorLocator
 from TemplateFiles.generate_template import generate_template
-from math import ceil 
 from PIL import Image
 import csv
-
-standard_values = {'y_grid_size' : 0.5,
-                   'x_grid_size' : 0.2,
-                   'y_grid_inch' : 5/25.4,
-                   'x_grid_inch' : 5/25.4,
-                   'grid_line_width' : 0.5,
-                   'lead_name_offset' : 0.5,
-                   'lead_fontsize' : 11,
-                   'x_gap' : 1,
-                   'y_gap' : 0.5,
-                   'display_factor' : 1,
-                   'line_width': 0.75,
-                   'row_height' : 8,
-                   'dc_offset_length' : 0.2,
-                   'lead_length' : 3,
-                   'V1_length' : 12,
-                   'width' : 11,
-                   'height' : 8.5
-                   }
+from profiling import stage, start_stage, end_stage
+from grid_cache import composite_over_background
+from raster_renderer import create_raster_page
+from bounding_boxes import get_line_extent, get_text_extent
+from page_layout import standard_values, get_page_layout
 
 standard_major_colors = {'colour1' : (0.4274,0.196,0.1843), #brown
                           'colour2' : (1,0.796,0.866), #pink
@@ -43,18 +29,137 @@ standard_minor_colors = {'colour1' : (0.5882,0.4196,0.3960),
                          'colour5' : (0.996,0.8745,0.8588)
     }
 
-papersize_values = {'A0' : (33.1,46.8),
-                    'A1' : (33.1,23.39),
-                    'A2' : (16.54,23.39),
-                    'A3' : (11.69,16.54),
-                    'A4' : (8.27,11.69),
-                    'letter' : (8.5,11)
-                    }
-
-
 def inches_to_dots(value,resolution):
     return (value * resolution)
 
+#Pixel coordinates (y from the top, x) of every plotted sample of a lead, transformed in a single batch
+#and kept as an array of shape (samples, 2) until the annotations are serialized
+def get_plotted_pixels(ax, x_vals, y_vals, height):
+    points = ax.transData.transform(np.column_stack((x_vals, y_vals)))
+    return np.round(np.column_stack((height - points[:, 1], points[:, 0])), 2)
+
+def decimate_trace(ax, x_vals, y_vals):
+    """Samples of a trace that draw the same line at the resolution of ax
+
+    Within each pixel column only the lowest and highest samples are kept, in their
+    original order, so the drawn envelope of every column is unchanged while the number
+    of vertices is bounded by twice the width of the trace in pixels. The first and last
+    samples of the trace and of each run of missing (NaN) samples are kept too, so the
+    trace starts, ends and has its gaps where it did.
+
+    Args:
+        ax (Axes): Axes the trace is plotted on
+        x_vals, y_vals (ndarray): Coordinates of the samples, x increasing
+    Returns:
+        x_vals, y_vals (ndarray): Coordinates of the kept samples
+    """
+    columns = np.floor(ax.transData.transform(np.column_stack((x_vals, np.zeros(len(x_vals)))))[:, 0])
+    missing = np.isnan(y_vals)
+    #A group is a run of samples within one pixel column that are all present or all missing
+    starts = np.flatnonzero(np.concatenate(([True], (np.diff(columns) != 0) | (missing[1:] != missing[:-1]))))
+    if len(starts)*2 >= len(x_vals):
+        return x_vals, y_vals
+    ends = np.append(starts[1:], len(x_vals)) - 1
+    group = np.repeat(np.arange(len(starts)), ends - starts + 1)
+    filled = np.where(missing, 0, y_vals)
+    kept = [[0, len(x_vals) - 1], starts[missing[starts]], ends[missing[ends]]]
+    for extreme in (np.minimum, np.maximum):
+        at_extreme = np.flatnonzero((filled == extreme.reduceat(filled, starts)[group]) & ~missing)
+        kept.append(at_extreme[np.unique(group[at_extreme], return_index=True)[1]])
+    kept = np.unique(np.concatenate(kept))
+    return x_vals[kept], y_vals[kept]
+
+#Sample a random major and minor grid colour pair
+def sample_random_grid_pair(rng):
+    major_random_color_sampler_red = rng.uniform(0,0.8)
+    major_random_color_sampler_green = rng.uniform(0,0.5)
+    major_random_color_sampler_blue = rng.uniform(0,0.5)
+
+    minor_offset = rng.uniform(0,0.2)
+    minor_random_color_sampler_red = major_random_color_sampler_red + minor_offset
+    minor_random_color_sampler_green = rng.uniform(0,0.5) + minor_offset
+    minor_random_color_sampler_blue = rng.uniform(0,0.5) + minor_offset
+
+    color_major = (major_random_color_sampler_red,major_random_color_sampler_green,major_random_color_sampler_blue)
+    color_minor = (minor_random_color_sampler_red,minor_random_color_sampler_green,minor_random_color_sampler_blue)
+    return color_major, color_minor
+
+#Fixed palette of random grid colour pairs, so that the number of distinct cached grid backgrounds stays bounded
+grid_palettes = dict()
+def get_grid_palette(palette_size):
+    if palette_size not in grid_palettes:
+        rng = random.Random(palette_size)
+        grid_palettes[palette_size] = [sample_random_grid_pair(rng) for i in range(palette_size)]
+    return grid_palettes[palette_size]
+
+#Sample the major grid, minor grid and trace colours. Random grid colours are drawn from a palette of palette_size pairs when it is not 0
+def sample_grid_colours(style, standard_colours, palette_size=0):
+    if (style == 'bw'):
+        color_major = (0.4,0.4,0.4)
+        color_minor = (0.75, 0.75, 0.75)
+        color_line  = (0,0,0)
+    elif(standard_colours > 0):
+        random_colour_index = standard_colours
+        color_major = standard_major_colors['colour'+str(random_colour_index)]
+        color_minor = standard_minor_colors['colour'+str(random_colour_index)]
+        grey_random_color = random.uniform(0,0.2)
+        color_line  = (grey_random_color,grey_random_color,grey_random_color)
+    else:
+        if palette_size > 0:
+            color_major, color_minor = random.choice(get_grid_palette(palette_size))
+        else:
+            color_major, color_minor = sample_random_grid_pair(random)
+
+        grey_random_color = random.uniform(0,0.2)
+        color_line  = (grey_random_color,grey_random_color,grey_random_color)
+
+    return color_major, color_minor, color_line
+
+#Create the figure of an ECG page, with axes spanning the whole page. The figure has its own Agg canvas and is not registered with pyplot
+def create_page_figure(width, height, resolution, x_min, x_max, y_min, y_max):
+    fig = Figure(figsize=(width, height), dpi=resolution)
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+   
+    fig.subplots_adjust(
+        hspace = 0, 
+        wspace = 0,
+        left   = 0,  
+        right  = 1,  
+        bottom = 0,  
+        top    = 1
+        )
+
+    ax.set_ylim(y_min,y_max)
+    ax.set_xlim(x_min,x_max)
+    ax.tick_params(axis='x', colors='white')
+    ax.tick_params(axis='y', colors='white')
+    return fig, ax
+
+#Draw the major and minor grid lines, 0.2 seconds and 0.5 mV per major square
+def draw_grid(ax, x_min, x_max, y_min, y_max, color_major, color_minor):
+    ax.set_xticks(np.arange(x_min,x_max,standard_values['x_grid_size']))    
+    ax.set_yticks(np.arange(y_min,y_max,standard_values['y_grid_size']))
+    ax.minorticks_on()
+    
+    ax.xaxis.set_minor_locator(AutoMinorLocator(5))
+
+    #set grid line style
+    ax.grid(which='major', linestyle='-', linewidth=standard_values['grid_line_width'], color=color_major)
+    
+    ax.grid(which='minor', linestyle='-', linewidth=standard_values['grid_line_width'], color=color_minor)
+
+#Render the background of a page, i.e. the grid and the axes frame, as an opaque RGBA array
+def render_grid_background(width, height, resolution, x_max, y_max, show_grid, color_major, color_minor):
+    fig, ax = create_page_figure(width, height, resolution, 0, x_max, 0, y_max)
+    if(show_grid):
+        draw_grid(ax, 0, x_max, 0, y_max, color_major, color_minor)
+    else:
+        ax.grid(False)
+    fig.canvas.draw()
+    background = np.array(fig.canvas.buffer_rgba())
+    return background
+
 #Function to plot raw ecg signal
 def ecg_plot(
         ecg, 
@@ -69,6 +174,7 @@ def ecg_plot(
         full_mode,
         store_text_bbox,
         full_header_file,
+        store_plotted_pixels = True,
         units          = '',
         papersize      = '',
         x_gap          = standard_values['x_gap'],
@@ -89,7 +195,14 @@ def ecg_plot(
         json_dict=dict(),
         start_index=-1,
         store_configs=0,
-        lead_length_in_seconds=10
+        lead_length_in_seconds=10,
+        return_image=False,
+        grid_colours=None,
+        grid_cache=None,
+        renderer='matplotlib',
+        figure_pool=None,
+        decimate_traces=False,
+        layout=None
         ):
     #Inputs :
     #ecg - Dictionary of ecg signal with lead names as keys
@@ -105,29 +218,25 @@ def ecg_plot(
     #show_lead_name - Option to show lead names or skip
     #show_dc_pulse - Option to show dc pulse
     #show_grid - Turn grid on or off
+    #grid_colours - Major grid, minor grid and trace colours, sampled when not given
+    #return_image - Return the rendered RGBA image as an array instead of saving it as a PNG
+    #grid_cache - GridBackgroundCache, when given with return_image the grid is drawn once per key and the traces over a copy of it
+    #renderer - 'matplotlib', or 'raster' to draw the page directly into an array with OpenCV and PIL, see raster_renderer
+    #figure_pool - PageFigurePool, when given the matplotlib figure of the page layout is reused instead of created and closed
+    #decimate_traces - Plot the per-pixel-column envelope of each lead instead of every sample, see decimate_trace. Bounding boxes and plotted pixels still use every sample
+    #layout - PageLayout of the page, computed from the other arguments when not given, see page_layout
 
 
-    #Initialize some params
-    #secs represents how many seconds of ecg are plotted
-    #leads represent number of leads in the ecg
-    #rows are calculated based on corresponding number of leads and number of columns
-
     matplotlib.use("Agg")
 
     #check if the ecg dict is empty
     if ecg == {}:
         return 
 
-    secs = lead_length_in_seconds
-
-    leads = len(lead_index)
-
-    rows  = int(ceil(leads/columns))
+    #Rows, page size, grid and lead positions only depend on the layout of the page
+    if layout is None:
+        layout = get_page_layout(lead_index, columns, full_mode, papersize, resolution, lead_length_in_seconds, sample_rate, configs)
 
-    if(full_mode!='None'):
-        rows+=1
-        leads+=1
-    
     #Grid calibration
     #Each big grid corresponds to 0.2 seconds and 0.5 mV
     #To do: Select grid size in a better way
@@ -139,120 +248,56 @@ def ecg_plot(
 
 
     #Set max and min coordinates to mark grid. Offset x_max slightly (i.e by 1 column width)
+    width, height = layout.width, layout.height
+    y_grid_dots, x_grid_dots = layout.y_grid_dots, layout.x_grid_dots
+    row_height = layout.row_height
+    x_min, x_max = layout.x_min, layout.x_max
+    y_min, y_max = layout.y_min, layout.y_max
+    x_gap = layout.x_gap
+
+    json_dict['width'] = layout.width_pixels
+    json_dict['height'] = layout.height_pixels
+    #With a cached background, the figure only holds the traces and text on a transparent page
+    use_grid_cache = return_image and grid_cache is not None and renderer == 'matplotlib'
 
-    if papersize=='':
-        width = standard_values['width']
-        height = standard_values['height']
-    else:
-        width = papersize_values[papersize][1]
-        height = papersize_values[papersize][0]
-    
-    y_grid = standard_values['y_grid_inch'] 
-    x_grid = standard_values['x_grid_inch']
-    y_grid_dots = y_grid*resolution
-    x_grid_dots = x_grid*resolution
- 
-    #row_height = height * y_grid_size/(y_grid*(rows+2))
-    row_height = (height * y_grid_size/y_grid)/(rows+2)
-    x_max = width * x_grid_size / x_grid
-    x_min = 0
-    x_gap = np.floor(((x_max - (columns*secs))/2)/0.2)*0.2
-    y_min = 0
-    y_max = height * y_grid_size/y_grid
-
-    json_dict['width'] = int(width*resolution)
-    json_dict['height'] = int(height*resolution)
     #Set figure and subplot sizes
-    fig, ax = plt.subplots(figsize=(width, height), dpi=resolution)
-   
-    fig.subplots_adjust(
-        hspace = 0, 
-        wspace = 0,
-        left   = 0,  
-        right  = 1,  
-        bottom = 0,  
-        top    = 1
-        )
+    if renderer == 'raster':
+        fig, ax = create_raster_page(width, height, resolution, x_min, x_max, y_min, y_max)
+    elif figure_pool is not None:
+        page_key = (width, height, resolution, x_max, y_max, use_grid_cache)
+        fig, ax = figure_pool.get(page_key, lambda: create_page_figure(width, height, resolution, x_min, x_max, y_min, y_max))
+    else:
+        fig, ax = create_page_figure(width, height, resolution, x_min, x_max, y_min, y_max)
 
     fig.suptitle(title)
 
+    if use_grid_cache:
+        fig.patch.set_alpha(0)
+        ax.set_axis_off()
+
     #Mark grid based on whether we want black and white or colour
     
-    if (style == 'bw'):
-        color_major = (0.4,0.4,0.4)
-        color_minor = (0.75, 0.75, 0.75)
-        color_line  = (0,0,0)
-    elif(standard_colours > 0):
-        random_colour_index = standard_colours
-        color_major = standard_major_colors['colour'+str(random_colour_index)]
-        color_minor = standard_minor_colors['colour'+str(random_colour_index)]
-        grey_random_color = random.uniform(0,0.2)
-        color_line  = (grey_random_color,grey_random_color,grey_random_color)
-    else:
-        major_random_color_sampler_red = random.uniform(0,0.8)
-        major_random_color_sampler_green = random.uniform(0,0.5)
-        major_random_color_sampler_blue = random.uniform(0,0.5)
-
-        minor_offset = random.uniform(0,0.2)
-        minor_random_color_sampler_red = major_random_color_sampler_red + minor_offset
-        minor_random_color_sampler_green = random.uniform(0,0.5) + minor_offset
-        minor_random_color_sampler_blue = random.uniform(0,0.5) + minor_offset
-
-        grey_random_color = random.uniform(0,0.2)
-        color_major = (major_random_color_sampler_red,major_random_color_sampler_green,major_random_color_sampler_blue)
-        color_minor = (minor_random_color_sampler_red,minor_random_color_sampler_green,minor_random_color_sampler_blue)
-        
-        color_line  = (grey_random_color,grey_random_color,grey_random_color)
+    if grid_colours is None:
+        grid_colours = sample_grid_colours(style, standard_colours)
+    color_major, color_minor, color_line = grid_colours
 
-    #Set grid
-    #Standard ecg has grid size of 0.5 mV and 0.2 seconds. Set ticks accordingly
-    
-    ax.set_ylim(y_min,y_max)
-    ax.set_xlim(x_min,x_max)
-    ax.tick_params(axis='x', colors='white')
-    ax.tick_params(axis='y', colors='white')
-    
     #Step size will be number of seconds per sample i.e 1/sampling_rate
-    step = (1.0/sample_rate)
+    step = layout.step
 
     dc_offset = 0
     if(show_dc_pulse):
-        dc_offset = sample_rate*standard_values['dc_offset_length']*step
-    #Iterate through each lead in lead_index array.
-    y_offset = (row_height/2)
-    x_offset = 0
+        dc_offset = layout.dc_offset_length
+    #Dc pulse wave to plot at the beginning of each row. Dc pulse will be 0.2 seconds
+    x_range, dc_pulse = layout.dc_x, layout.dc_pulse
 
     leads_ds = []
 
-    leadNames_12 = configs['leadNames_12']
-    tickLength = configs['tickLength']
-    tickSize_step = configs['tickSize_step']
-
-    for i in np.arange(len(lead_index)):
+    #Iterate through each lead in lead_index array.
+    #y_offset shifts each row by row_height, and by row_height/2 to account for half the waveform below the axis
+    #x_offset will be distance by which we shift the plot in each column
+    for i, (leadName, x_offset, y_offset) in enumerate(layout.leads):
         current_lead_ds = dict()
 
-        if len(lead_index) == 12:
-            leadName = leadNames_12[i]
-        else:
-            leadName = lead_index[i]
-        #y_offset is computed by shifting by a certain offset based on i, and also by row_height/2 to account for half the waveform below the axis
-        if(i%columns==0):
-
-            y_offset += row_height
-        
-        #x_offset will be distance by which we shift the plot in each iteration
-        if(columns>1):
-            x_offset = (i%columns)*secs
-            
-        else:
-            x_offset = 0
-
-        #Create dc pulse wave to plot at the beginning of plot. Dc pulse will be 0.2 seconds
-        x_range = np.arange(0,sample_rate*standard_values['dc_offset_length']*step + 4*step,step)
-        dc_pulse = np.ones(len(x_range))
-        dc_pulse = np.concatenate(((0,0),dc_pulse[2:-2],(0,0)))
-
-        #Print lead name at .5 ( or 5 mm distance) from plot
         if(show_lead_name):
             t1 = ax.text(x_offset + x_gap + dc_offset, 
                     y_offset-lead_name_offset - 0.2, 
@@ -260,9 +305,7 @@ def ecg_plot(
                     fontsize=lead_fontsize)
             
             if (store_text_bbox):
-                renderer1 = fig.canvas.get_renderer()
-                transf = ax.transData.inverted()
-                bb = t1.get_window_extent()    
+                bb = get_text_extent(ax, t1)
                 x1 = bb.x0*resolution/fig.dpi      
                 y1 = bb.y0*resolution/fig.dpi   
                 x2 = bb.x1*resolution/fig.dpi     
@@ -281,7 +324,7 @@ def ecg_plot(
         current_lead_ds["lead_name"] = leadName
 
         #If we are plotting the first row-1 plots, we plot the dc pulse prior to adding the waveform
-        if(columns == 1 and i in np.arange(0,rows)):
+        if(columns == 1 and i in np.arange(0,layout.rows)):
             if(show_dc_pulse):
                 #Plot dc pulse for 0.2 seconds with 2 trailing and leading zeros to get the pulse
                 t1 = ax.plot(x_range + x_offset + x_gap,
@@ -290,9 +333,7 @@ def ecg_plot(
                         color=color_line
                         )
                 if (bbox):
-                    renderer1 = fig.canvas.get_renderer()
-                    transf = ax.transData.inverted()
-                    bb = t1[0].get_window_extent()                                                
+                    bb = get_line_extent(ax, x_range + x_offset + x_gap, dc_pulse+y_offset)
                     x1, y1 = bb.x0*resolution/fig.dpi, bb.y0*resolution/fig.dpi
                     x2, y2 = bb.x1*resolution/fig.dpi, bb.y1*resolution/fig.dpi
                     
@@ -300,31 +341,26 @@ def ecg_plot(
         elif(i%columns == 0):
             if(show_dc_pulse):
                 #Plot dc pulse for 0.2 seconds with 2 trailing and leading zeros to get the pulse
-                t1 = ax.plot(np.arange(0,sample_rate*standard_values['dc_offset_length']*step + 4*step,step) + x_offset + x_gap,
+                t1 = ax.plot(x_range + x_offset + x_gap,
                         dc_pulse+y_offset,
                         linewidth=line_width * 1.5, 
                         color=color_line
                         )
                 if (bbox):
-                    renderer1 = fig.canvas.get_renderer()
-                    transf = ax.transData.inverted()
-                    bb = t1[0].get_window_extent()                                                
+                    bb = get_line_extent(ax, x_range + x_offset + x_gap, dc_pulse+y_offset)
                     x1, y1 = bb.x0*resolution/fig.dpi, bb.y0*resolution/fig.dpi
                     x2, y2 = bb.x1*resolution/fig.dpi, bb.y1*resolution/fig.dpi
 
-        t1 = ax.plot(np.arange(0,len(ecg[leadName])*step,step) + x_offset + dc_offset + x_gap, 
-                ecg[leadName] + y_offset,
+        x_vals = layout.get_time_axis(len(ecg[leadName])) + x_offset + dc_offset + x_gap
+        y_vals = ecg[leadName] + y_offset
+
+        t1 = ax.plot(*(decimate_trace(ax, x_vals, y_vals) if decimate_traces else (x_vals, y_vals)),
                 linewidth=line_width, 
                 color=color_line
                 )
-        
-        x_vals = np.arange(0,len(ecg[leadName])*step,step) + x_offset + dc_offset + x_gap
-        y_vals = ecg[leadName] + y_offset
 
         if (bbox):
-            renderer1 = fig.canvas.get_renderer()
-            transf = ax.transData.inverted()
-            bb = t1[0].get_window_extent()  
+            bb = get_line_extent(ax, x_vals, y_vals)
             if show_dc_pulse == False or (columns == 4 and (i != 0 and i != 4 and i != 8)):                                           
                 x1, y1 = bb.x0*resolution/fig.dpi, bb.y0*resolution/fig.dpi
                 x2, y2 = bb.x1*resolution/fig.dpi, bb.y1*resolution/fig.dpi
@@ -343,28 +379,18 @@ def ecg_plot(
             box_dict[3] = [round(json_dict['height'] - y1, 2), round(x1, 2)]
             current_lead_ds["lead_bounding_box"] = box_dict
         
-        st = start_index
-        if columns == 4 and leadName in configs['format_4_by_3'][1]:
-            st = start_index + int(sample_rate*configs['paper_len']/columns)
-        elif columns == 4 and leadName in configs['format_4_by_3'][2]:
-            st = start_index + int(2*sample_rate*configs['paper_len']/columns)
-        elif columns == 4 and leadName in configs['format_4_by_3'][3]:
-            st = start_index + int(3*sample_rate*configs['paper_len']/columns)
+        st = start_index + layout.get_sample_offset(leadName)
         current_lead_ds["start_sample"] = st
         current_lead_ds["end_sample"]= st + len(ecg[leadName])
-        current_lead_ds["plotted_pixels"] = []
-        for j in range(len(x_vals)):
-            xi, yi = x_vals[j], y_vals[j]
-            xi, yi = ax.transData.transform((xi, yi))
-            yi = json_dict['height'] - yi
-            current_lead_ds['plotted_pixels'].append([round(yi, 2), round(xi, 2)])
+        if (store_plotted_pixels):
+            current_lead_ds["plotted_pixels"] = get_plotted_pixels(ax, x_vals, y_vals, json_dict['height'])
 
         leads_ds.append(current_lead_ds)
 
         if columns > 1 and (i+1)%columns != 0:
-            sep_x = [len(ecg[leadName])*step + x_offset + dc_offset + x_gap] * round(tickLength*y_grid_dots)
+            sep_x = [len(ecg[leadName])*step + x_offset + dc_offset + x_gap] * layout.tick_count
             sep_x = np.array(sep_x)
-            sep_y = np.linspace(y_offset - tickLength/2*y_grid_dots*tickSize_step, y_offset + tickSize_step*y_grid_dots*tickLength/2, len(sep_x))
+            sep_y = layout.tick_y[i]
             ax.plot(sep_x, sep_y, linewidth=line_width * 3, color=color_line)
 
     #Plotting longest lead for 12 seconds
@@ -377,9 +403,7 @@ def ecg_plot(
                     fontsize=lead_fontsize)
             
             if (store_text_bbox):
-                renderer1 = fig.canvas.get_renderer()
-                transf = ax.transData.inverted()
-                bb = t1.get_window_extent(renderer = fig.canvas.renderer)
+                bb = get_text_extent(ax, t1)
                 x1 = bb.x0*resolution/fig.dpi      
                 y1 = bb.y0*resolution/fig.dpi   
                 x2 = bb.x1*resolution/fig.dpi     
@@ -404,28 +428,23 @@ def ecg_plot(
                     )
             
             if (bbox):
-                    renderer1 = fig.canvas.get_renderer()
-                    transf = ax.transData.inverted()
-                    bb = t1[0].get_window_extent()                                                
+                    bb = get_line_extent(ax, x_range + x_gap, dc_pulse + row_height/2-lead_name_offset + 0.8)
                     x1, y1 = bb.x0*resolution/fig.dpi, bb.y0*resolution/fig.dpi
                     x2, y2 = bb.x1*resolution/fig.dpi, bb.y1*resolution/fig.dpi
         
         dc_full_lead_offset = 0 
         if(show_dc_pulse):
-            dc_full_lead_offset = sample_rate*standard_values['dc_offset_length']*step
+            dc_full_lead_offset = layout.dc_offset_length
         
-        t1 = ax.plot(np.arange(0,len(ecg['full'+full_mode])*step,step) + x_gap + dc_full_lead_offset, 
-                    ecg['full'+full_mode] + row_height/2-lead_name_offset + 0.8,
+        x_vals = layout.get_time_axis(len(ecg['full'+full_mode])) + x_gap + dc_full_lead_offset
+        y_vals = ecg['full'+full_mode] + row_height/2-lead_name_offset + 0.8
+        t1 = ax.plot(*(decimate_trace(ax, x_vals, y_vals) if decimate_traces else (x_vals, y_vals)),
                     linewidth=line_width, 
                     color=color_line
                     )
-        x_vals = np.arange(0,len(ecg['full'+full_mode])*step,step) + x_gap + dc_full_lead_offset
-        y_vals = ecg['full'+full_mode] + row_height/2-lead_name_offset + 0.8
 
         if (bbox):
-            renderer1 = fig.canvas.get_renderer()
-            transf = ax.transData.inverted()
-            bb = t1[0].get_window_extent()  
+            bb = get_line_extent(ax, x_vals, y_vals)
             if show_dc_pulse == False:                                           
                 x1, y1 = bb.x0*resolution/fig.dpi, bb.y0*resolution/fig.dpi
                 x2, y2 = bb.x1*resolution/fig.dpi, bb.y1*resolution/fig.dpi
@@ -446,12 +465,8 @@ def ecg_plot(
             current_lead_ds["lead_bounding_box"] = box_dict
         current_lead_ds["start_sample"] = start_index
         current_lead_ds["end_sample"] = start_index + len(ecg['full'+full_mode])
-        current_lead_ds['plotted_pixels'] = []
-        for i in range(len(x_vals)):
-            xi, yi = x_vals[i], y_vals[i]
-            xi, yi = ax.transData.transform((xi, yi))
-            yi = json_dict['height'] - yi
-            current_lead_ds['plotted_pixels'].append([round(yi, 2), round(xi, 2)])
+        if (store_plotted_pixels):
+            current_lead_ds['plotted_pixels'] = get_plotted_pixels(ax, x_vals, y_vals, json_dict['height'])
         leads_ds.append(current_lead_ds)
 
 
@@ -486,32 +501,56 @@ def ecg_plot(
     ax.text(2, 0.5, '25mm/s', fontsize=lead_fontsize)
     ax.text(4, 0.5, '10mm/mV', fontsize=lead_fontsize)
     
+    #Set grid
+    #Standard ecg has grid size of 0.5 mV and 0.2 seconds. Set ticks accordingly
     if(show_grid):
-        ax.set_xticks(np.arange(x_min,x_max,x_grid_size))    
-        ax.set_yticks(np.arange(y_min,y_max,y_grid_size))
-        ax.minorticks_on()
-        
-        ax.xaxis.set_minor_locator(AutoMinorLocator(5))
-
-        #set grid line style
-        ax.grid(which='major', linestyle='-', linewidth=grid_line_width, color=color_major)
-        
-        ax.grid(which='minor', linestyle='-', linewidth=grid_line_width, color=color_minor)
+        if renderer == 'raster':
+            ax.draw_grid(x_grid_size, y_grid_size, 5, color_major, color_minor, grid_line_width)
+        elif not use_grid_cache:
+            draw_grid(ax, x_min, x_max, y_min, y_max, color_major, color_minor)
         
         if store_configs == 2:
             json_dict['grid_line_color_major'] = [round(x*255., 2) for x in color_major]
             json_dict['grid_line_color_minor'] = [round(x*255., 2) for x in color_minor]
             json_dict['ecg_plot_color'] = [round(x*255., 2) for x in color_line]
-    else:
+    elif renderer == 'matplotlib' and not use_grid_cache:
         ax.grid(False)
 
-    plt.savefig(os.path.join(output_dir,tail +'.png'),dpi=resolution)
-    plt.close(fig)
-    plt.clf()
-    plt.cla()
+    if return_image:
+        #Render the figure with the Agg canvas and read back its pixel buffer, the caller decides how to encode it
+        with stage('render'):
+            if renderer == 'raster':
+                ecg_image = fig.render()
+            else:
+                fig.canvas.draw()
+                ecg_image = np.array(fig.canvas.buffer_rgba())
+
+        if use_grid_cache:
+            with stage('grid_background'):
+                grid_key = (width, height, resolution, bool(show_grid), tuple(color_major) if show_grid else None, tuple(color_minor) if show_grid else None)
+                background = grid_cache.get(grid_key, lambda: render_grid_background(width, height, resolution, x_max, y_max, show_grid, color_major, color_minor))
+                ecg_image = composite_over_background(ecg_image, background)
+
+        if pad_inches!=0:
+            with stage('padding'):
+                pad = pad_inches * resolution
+                #Same opaque white border as the PNG padding below
+                result_image = np.full((ecg_image.shape[0] + 2*pad, ecg_image.shape[1] + 2*pad, ecg_image.shape[2]), 255, dtype=ecg_image.dtype)
+                result_image[pad:pad + ecg_image.shape[0], pad:pad + ecg_image.shape[1]] = ecg_image
+                ecg_image = result_image
+
+        json_dict["leads"] = leads_ds
+
+        return x_grid_dots,y_grid_dots,ecg_image
+
+    with stage('savefig'):
+        if renderer == 'raster':
+            Image.fromarray(fig.render()).save(os.path.join(output_dir,tail +'.png'))
+        else:
+            fig.savefig(os.path.join(output_dir,tail +'.png'),dpi=resolution)
 
     if pad_inches!=0:
-        
+        start_stage('padding')
         ecg_image = Image.open(os.path.join(output_dir,tail +'.png'))
         
         right = pad_inches * resolution
@@ -525,11 +564,7 @@ def ecg_plot(
         result_image.paste(ecg_image, (left, top))
         
         result_image.save(os.path.join(output_dir,tail +'.png'))
-
-        plt.close('all')
-        plt.close(fig)
-        plt.clf()
-        plt.cla()
+        end_stage('padding')
 
     json_dict["leads"] = leads_ds
 
@@ -0,0 +1,33 @@
+from lru_cache import LRUCache
+
+class PageFigurePool:
+    """Matplotlib figures of ECG pages, kept across records and reused for every page of the same layout
+
+    Creating, laying out and closing a figure for every page costs more than drawing
+    its traces, so one figure and axes is kept per page size, resolution and background,
+    least recently used first evicted. Between pages only the data artists, i.e. the
+    lines and texts of the axes, are removed and the grid is turned off; the limits
+    and spines stay. The figures are not registered with pyplot, so a pool can be used
+    from any thread, but only by one thread at a time: each worker owns its own pool.
+
+    Args:
+        max_figures (int): Number of figures kept
+    """
+    def __init__(self, max_figures=4):
+        self.figures = LRUCache(max_entries=max_figures)
+
+    def get(self, key, create):
+        """Return the cleared figure and axes of key, created by create() when it is not pooled"""
+        figure = self.figures.lookup(key)
+        if figure is not None:
+            clear_page(figure[1])
+            return figure
+        return self.figures.put(key, create())
+
+#Remove the traces and text of the previous page and turn its major and minor grid off, as on a new figure.
+#The suptitle of the figure is reused by the next fig.suptitle call
+def clear_page(ax):
+    for artist in list(ax.lines) + list(ax.texts):
+        artist.remove()
+    ax.grid(False, which='both')
+    ax.minorticks_off()
@@ -0,0 +1,87 @@
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from matplotlib.font_manager import get_font
+from lru_cache import LRUCache
+
+#Font of the file at path scaled to pixels, with the minimum ascent and descent of a line of text, see FontCache.get_font
+def load_font(path, fontsize, dpi):
+    size = fontsize*dpi/72
+    font = ImageFont.truetype(path, size)
+    table = get_font(path).get_sfnt_table('OS/2')
+    if table is not None:
+        scale = size/get_font(path).get_sfnt_table('head')['unitsPerEm']
+        ascent, descent = table['sTypoAscender']*scale, -table['sTypoDescender']*scale
+    else:
+        ascent, descent = font.getmetrics()
+    return font, ascent, descent
+
+class FontCache:
+    """Fonts, text extents and rasterised text sprites shared by every image of a process
+
+    A page draws the same dozen lead names, the speed and gain labels and the header
+    text, at the same few sizes and resolutions, so each font is loaded once per
+    (font file, size, resolution), each string is measured once and the glyph mask of
+    each string is rasterised once per position within a pixel. Every table is evicted
+    least recently used first, which bounds the cache when the resolution is random.
+
+    Args:
+        max_fonts (int): Number of loaded fonts kept
+        max_extents (int): Number of text extents kept
+        max_sprite_bytes (int): Memory budget of the text sprites
+    """
+    def __init__(self, max_fonts=32, max_extents=4096, max_sprite_bytes=32*1024*1024):
+        self.fonts = LRUCache(max_entries=max_fonts)
+        self.extents = LRUCache(max_entries=max_extents)
+        self.sprites = LRUCache(max_size=max_sprite_bytes, size=lambda sprite: sprite[0].nbytes)
+
+    def get_font(self, path, fontsize, dpi):
+        """Font of the file at path, at fontsize points on a page of dpi dots per inch
+
+        Returns:
+            font (FreeTypeFont): The font scaled to pixels
+            ascent, descent (float): Minimum ascent and descent of a line of text in pixels, which
+                matplotlib uses for the text bounding boxes whatever the glyphs of the string
+        """
+        return self.fonts.get((path, fontsize, dpi), lambda: load_font(path, fontsize, dpi))
+
+    def get_extent(self, key, measure):
+        """Extent of a string relative to its anchor, measured by measure() when it is not cached
+
+        Args:
+            key (tuple): Font file, font size, resolution and string
+            measure (function): Returns the extent as a tuple x0, y0, x1, y1 in pixels
+        """
+        return self.extents.get(key, measure)
+
+    def get_sprite(self, path, fontsize, dpi, text, anchor, column, row):
+        """Glyph mask of a string anchored at a position in pixels from the top left of the page
+
+        The mask only depends on the fractional part of the position, so it is rasterised
+        once per string and sub-pixel offset and positioned at the integer part.
+
+        Returns:
+            mask (ndarray): Read-only 8-bit coverage of the string
+            x0, y0 (int): Page position of the top left pixel of the mask
+        """
+        column_pixel, row_pixel = int(np.floor(column)), int(np.floor(row))
+        key = (path, fontsize, dpi, text, anchor, column - column_pixel, row - row_pixel)
+        sprite = self.sprites.lookup(key)
+        if sprite is not None:
+            mask, dx, dy = sprite
+            return mask, column_pixel + dx, row_pixel + dy
+
+        font = self.get_font(path, fontsize, dpi)[0]
+        column_offset, row_offset = column - column_pixel, row - row_pixel
+        left, top, right, bottom = font.getbbox(text, anchor=anchor)
+        dx, dy = int(np.floor(column_offset + left)) - 1, int(np.floor(row_offset + top)) - 1
+        width, height = int(np.ceil(column_offset + right)) + 1 - dx, int(np.ceil(row_offset + bottom)) + 1 - dy
+        image = Image.new('L', (width, height))
+        ImageDraw.Draw(image).text((column_offset - dx, row_offset - dy), text, fill=255, font=font, anchor=anchor)
+        mask = np.asarray(image)
+        mask.setflags(write=False)
+
+        self.sprites.put(key, (mask, dx, dy))
+        return mask, column_pixel + dx, row_pixel + dy
+
+#Cache of the process, used by the raster renderer and the bounding box computation
+font_cache = FontCache()
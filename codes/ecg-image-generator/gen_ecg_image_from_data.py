@@ -4,14 +4,17 @@ import csv
 import qrcode
 from PIL import Image
 import numpy as np
-from scipy.stats import bernoulli
-from helper_functions import find_files
+import cv2
+from helper_functions import find_files, set_random_seed, scale_annotations
 from extract_leads import get_paper_ecg
-from HandwrittenText.generate import get_handwritten
-from CreasesWrinkles.creases import get_creased
-from ImageAugmentation.augment import get_augment
+from HandwrittenText.generate import add_handwritten_text
+from CreasesWrinkles.creases import apply_creases
+from ImageAugmentation.augment import augment_image
 import warnings
-from helper_functions import read_config_file
+from worker_context import WorkerContext
+from profiling import stage, staged
+from job_plan import plan_record, get_standard_colours
+from output_sinks import IMAGE_EXTENSIONS
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2' 
 warnings.filterwarnings("ignore")
@@ -33,6 +36,16 @@ def get_parser():
     parser.add_argument('--full_mode', type=str,default='II')
     parser.add_argument('--mask_unplotted_samples', action="store_true", default=False)
     parser.add_argument('--add_qr_code', action="store_true", default=False)
+    parser.add_argument('--image_format', type=str, default='png', choices=['png', 'jpeg', 'webp', 'npy'])
+    parser.add_argument('--png_compression', type=int, default=6)
+    parser.add_argument('--image_quality', type=int, default=90)
+    parser.add_argument('--annotation_format', type=str, default='json', choices=['json', 'npz'])
+    parser.add_argument('--annotation_level', type=str, default=None, choices=['none', 'boxes', 'pixels', 'full'])
+    parser.add_argument('--grid_cache_mb', type=int, default=0)
+    parser.add_argument('--grid_palette_size', type=int, default=64)
+    parser.add_argument('--renderer', type=str, default='matplotlib', choices=['matplotlib', 'raster'])
+    parser.add_argument('--decimate_traces', action='store_true', default=False)
+    parser.add_argument('--output_resolutions', type=int, nargs='+', default=None)
 
     parser.add_argument('-l', '--link', type=str, required=False,default='')
     parser.add_argument('-n','--num_words',type=int,required=False,default=5)
@@ -97,153 +110,146 @@ def writeCSV(args):
             if args.start_index != -1:
                 writer.writerow(["filename","xgrid","ygrid","lead_name","start","end"])
 
-def run_single_file(args):
+#Annotation layers computed while rendering and augmenting: lead boxes, lead name boxes and plotted pixels.
+#Without --annotation_level, every layer is kept when annotations are written, and none for pure image generation.
+def get_annotation_layers(args):
+    level = args.annotation_level
+    if level is None:
+        level = 'full' if args.store_config or getattr(args, 'output_sink', 'files') == 'hdf5' else 'none'
+    boxes = level in ('boxes', 'full')
+    return args.lead_bbox and boxes, args.lead_name_bbox and boxes, level in ('pixels', 'full')
+
+#Stamp a QR code encoding the record name on the top right corner of the image
+def add_qr_code(img, encoding):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=5,
+        border=4,
+    )
+    qr.add_data(encoding)
+    qr.make(fit=True)
+
+    qr_img = np.array(qr.make_image(fill_color="black", back_color="white"))
+    qr_img_color = np.zeros((qr_img.shape[0], qr_img.shape[1], 3))
+    qr_img_color[:,:,0] = qr_img*255.
+    qr_img_color[:,:,1] = qr_img*255.
+    qr_img_color[:,:,2] = qr_img*255.
+    
+    img[:qr_img.shape[0], -qr_img.shape[1]:, :3] = qr_img_color
+    return img
+
+#Apply the distortions of one job plan image to a rendered ecg image, then hand the image and its annotations to the writer
+def process_ecg_image(args, context, out, image, json_dict, record, image_plan, output_files=None):
+    #Randomness left inside the distortions is driven by the seed of the image
+    set_random_seed(image_plan['seed'])
+    rec_tail, extn = os.path.splitext(out)
+    lead_bbox, text_bbox, plotted_pixels = get_annotation_layers(args)
+
+    #The image rendered by ecg_plot is passed in memory through the distortion stages and encoded once at the end
+    #Handwritten text addition
+    if(image_plan['hw_text']):
+        with stage('handwriting'):
+            image = add_handwritten_text(image,link=args.link,num_words=image_plan['num_words'],x_offset=image_plan['x_offset'],y_offset=image_plan['y_offset'],handwriting_size_factor=args.handwriting_size_factor,entities=context.get_medical_entities(args.link),handwriting_model=context.handwriting_model)
+
+    if args.store_config == 2:
+        json_dict['handwritten_text'] = bool(image_plan['hw_text'])
+        json_dict['num_words'] = image_plan['num_words']
+        json_dict['x_offset_for_handwritten_text'] = image_plan['x_offset']
+        json_dict['y_offset_for_handwritten_text'] = image_plan['y_offset']
+
+    if(image_plan['wrinkles']):
+        with stage('creases'):
+            image = apply_creases(image,ifWrinkles=True,ifCreases=True,crease_angle=image_plan['crease_angle'],num_creases_vertically=image_plan['num_creases_vertically'],num_creases_horizontally=image_plan['num_creases_horizontally'],wrinkle_textures=[context.get_wrinkle_texture(image_plan['wrinkle_texture'])])
+
+    if args.store_config == 2:
+        json_dict['wrinkles'] = bool(image_plan['wrinkles'])
+        json_dict['crease_angle'] = image_plan['crease_angle']
+        json_dict['number_of_creases_horizontally'] = image_plan['num_creases_horizontally']
+        json_dict['number_of_creases_vertically'] = image_plan['num_creases_vertically']
+
+    if(image_plan['augment']):
+        with stage('augment'):
+            image = augment_image(image,rotate=image_plan['rotate'],noise=image_plan['noise'],crop=image_plan['crop'],temperature=image_plan['temperature'],bbox = lead_bbox, store_text_bounding_box = text_bbox, store_plotted_pixels = plotted_pixels, json_dict = json_dict, rot=image_plan['rot'], crop_sample=image_plan['crop_sample'])
+
+    if args.store_config == 2:
+        json_dict['augment'] = bool(image_plan['augment'])
+        json_dict['crop'] = image_plan['crop']
+        json_dict['temperature'] = image_plan['temperature']
+        json_dict['rotate'] = image_plan['rotate']
+        json_dict['noise'] = image_plan['noise']
+
+    #Without --output_resolutions the image is written at the resolution it was rendered at
+    if args.output_resolutions is None:
+        write_ecg_image(args, context, out, image, json_dict, record, output_files)
+        return
+
+    #The distorted image is downscaled to every output resolution, its annotations are scaled by the same factors.
+    #The rendered resolution comes last, as the QR code is stamped on the rendered image itself
+    for resolution in sorted(set(args.output_resolutions)):
+        with stage('resize'):
+            scaled_image, scaled_json_dict = resize_ecg_image(image, json_dict, resolution)
+        write_ecg_image(args, context, rec_tail + '-' + str(resolution) + 'dpi' + extn, scaled_image, scaled_json_dict, record, output_files)
+
+#Downscale a rendered ecg image from the resolution in its annotations to resolution, with area averaging
+def resize_ecg_image(image, json_dict, resolution):
+    scale = resolution/json_dict['resolution']
+    if scale == 1:
+        return image, json_dict
+    height, width = image.shape[:2]
+    size = (max(int(round(width*scale)), 1), max(int(round(height*scale)), 1))
+    resized = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    #The exact factors of the resized image, which differ slightly from scale when the size is rounded
+    scaled_json_dict = scale_annotations(json_dict, size[0]/width, size[1]/height)
+    scaled_json_dict['resolution'] = resolution
+    return resized, scaled_json_dict
+
+#Stamp the QR code of the record on an image and hand the image and its annotations to the writer
+def write_ecg_image(args, context, out, image, json_dict, record, output_files=None):
+    rec_tail, extn = os.path.splitext(out)
+    if args.add_qr_code:
+        with stage('qr_code'):
+            image = add_qr_code(image, args.encoding)
+
+    #Samples written to a tar shard carry their own copy of the segmented record
+    json_file = rec_tail + '.json' if args.store_config else None
+    sample_record = record if context.sink.bundles_records else None
+    #Encoding and writing run on the writer threads, where they are timed
+    context.writer.submit(staged('encode', context.sink.write_sample), out, image, (args.image_format, args.png_compression, args.image_quality), json_file, json_dict, sample_record, args.annotation_format)
+
+    if output_files is not None:
+        output_files.append(out)
+        if args.store_config:
+            output_files.append(json_file)
+            if args.annotation_format == 'npz':
+                output_files.append(rec_tail + '.npz')
+        if sample_record is not None:
+            output_files.append(rec_tail + '.hea')
+            output_files.append(rec_tail + '.dat')
+
+#Generate the images of one record. Every random choice is sampled into a job plan first, unless a plan
+#from plan_record is given, so that a run and the replay of its plan produce the same images.
+def run_single_file(args, output_files=None, context=None, plan=None):
         if hasattr(args, 'st') == True:
             random.seed(args.seed)
             args.encoding = args.input_file
 
+        if context is None:
+            context = WorkerContext(os.path.join(os.getcwd(), args.config_file), grid_cache_mb=args.grid_cache_mb)
+
+        if plan is None:
+            plan = plan_record(args, context)
+
         filename = args.input_file
         header = args.header_file
-        resolution = random.choice(range(50,args.resolution+1)) if (args.random_resolution) else args.resolution
-        padding = random.choice(range(0,args.pad_inches+1)) if (args.random_padding) else args.pad_inches
         
         papersize = ''
         lead = args.remove_lead_names
+        font = os.path.join('Fonts',plan['font'])
+        configs = context.configs
+        lead_bbox, text_bbox, plotted_pixels = get_annotation_layers(args)
 
-        bernoulli_dc = bernoulli(args.calibration_pulse)
-        bernoulli_bw = bernoulli(args.random_bw)
-        bernoulli_grid = bernoulli(args.random_grid_present)
-        if args.print_header:
-            bernoulli_add_print = bernoulli(1)
-        else:
-            bernoulli_add_print = bernoulli(args.random_print_header)
-        
-        font = os.path.join('Fonts',random.choice(os.listdir("Fonts")))
-        
-        if(args.random_bw == 0):
-            if args.random_grid_color == False:
-                standard_colours = args.standard_grid_color
-            else:
-                standard_colours = -1
-        else:
-            standard_colours = False
-
-        configs = read_config_file(os.path.join(os.getcwd(), args.config_file))
-
-        out_array = get_paper_ecg(input_file=filename,header_file=header, configs=configs, mask_unplotted_samples=args.mask_unplotted_samples, start_index=args.start_index, store_configs=args.store_config, store_text_bbox=args.lead_name_bbox, output_directory=args.output_directory,resolution=resolution,papersize=papersize,add_lead_names=lead,add_dc_pulse=bernoulli_dc,add_bw=bernoulli_bw,show_grid=bernoulli_grid,add_print=bernoulli_add_print,pad_inches=padding,font_type=font,standard_colours=standard_colours,full_mode=args.full_mode,bbox = args.lead_bbox, columns = args.num_columns, seed=args.seed)
-        
-        for out in out_array:
-            if args.store_config:
-                rec_tail, extn = os.path.splitext(out)
-                with open(rec_tail  + '.json', 'r') as file:
-                    json_dict = json.load(file)
-            else:
-                json_dict = None
-            if(args.fully_random):
-                hw_text = random.choice((True,False))
-                wrinkles = random.choice((True,False))
-                augment = random.choice((True,False))
-            else:
-                hw_text = args.hw_text
-                wrinkles = args.wrinkles
-                augment = args.augment
-            
-            #Handwritten text addition
-            if(hw_text):
-                num_words = args.num_words if (args.deterministic_num_words) else random.choice(range(2,args.num_words+1))
-                x_offset = args.x_offset if (args.deterministic_offset) else random.choice(range(1,args.x_offset+1))
-                y_offset = args.y_offset if (args.deterministic_offset) else random.choice(range(1,args.y_offset+1))
-
-                out = get_handwritten(link=args.link,num_words=num_words,input_file=out,output_dir=args.output_directory,x_offset=x_offset,y_offset=y_offset,handwriting_size_factor=args.handwriting_size_factor,bbox = args.lead_bbox)
-            else:
-                num_words = 0
-                x_offset = 0
-                y_offset = 0
-
-            if args.store_config == 2:
-                json_dict['handwritten_text'] = bool(hw_text)
-                json_dict['num_words'] = num_words
-                json_dict['x_offset_for_handwritten_text'] = x_offset
-                json_dict['y_offset_for_handwritten_text'] = y_offset
-            
-            if(wrinkles):
-                ifWrinkles = True
-                ifCreases = True
-                crease_angle = args.crease_angle if (args.deterministic_angle) else random.choice(range(0,args.crease_angle+1))
-                num_creases_vertically = args.num_creases_vertically if (args.deterministic_vertical) else random.choice(range(1,args.num_creases_vertically+1))
-                num_creases_horizontally = args.num_creases_horizontally if (args.deterministic_horizontal) else random.choice(range(1,args.num_creases_horizontally+1))
-                out = get_creased(out,output_directory=args.output_directory,ifWrinkles=ifWrinkles,ifCreases=ifCreases,crease_angle=crease_angle,num_creases_vertically=num_creases_vertically,num_creases_horizontally=num_creases_horizontally,bbox = args.lead_bbox)
-            else:
-                crease_angle = 0
-                num_creases_horizontally = 0
-                num_creases_vertically = 0
-
-            if args.store_config == 2:
-                json_dict['wrinkles'] = bool(wrinkles)
-                json_dict['crease_angle'] = crease_angle
-                json_dict['number_of_creases_horizontally'] = num_creases_horizontally
-                json_dict['number_of_creases_vertically'] = num_creases_vertically
-
-            if(augment):
-                noise = args.noise if (args.deterministic_noise) else random.choice(range(1,args.noise+1))
-            
-                if(not args.lead_bbox):
-                    do_crop = random.choice((True,False))
-                    if(do_crop):
-                        crop = args.crop
-                    else:
-                        crop = args.crop
-                else:
-                    crop = 0
-                blue_temp = random.choice((True,False))
-
-                if(blue_temp):
-                    temp = random.choice(range(2000,4000))
-                else:
-                    temp = random.choice(range(10000,20000))
-                rotate = args.rotate
-                out = get_augment(out,output_directory=args.output_directory,rotate=args.rotate,noise=noise,crop=crop,temperature=temp,bbox = args.lead_bbox, store_text_bounding_box = args.lead_name_bbox, json_dict = json_dict)
-            
-            else:
-                crop = 0
-                temp = 0
-                rotate = 0
-                noise = 0
-            if args.store_config == 2:
-                json_dict['augment'] = bool(augment)
-                json_dict['crop'] = crop
-                json_dict['temperature'] = temp
-                json_dict['rotate'] = rotate
-                json_dict['noise'] = noise
-
-            if args.store_config:
-                json_object = json.dumps(json_dict, indent=4)
-                
-                with open(rec_tail + '.json', "w") as f:
-                    f.write(json_object)
-
-
-            if args.add_qr_code:
-                img = np.array(Image.open(out))
-                qr = qrcode.QRCode(
-                    version=1,
-                    error_correction=qrcode.constants.ERROR_CORRECT_L,
-                    box_size=5,
-                    border=4,
-                )
-                qr.add_data(args.encoding)
-                qr.make(fit=True)
-
-                qr_img = np.array(qr.make_image(fill_color="black", back_color="white"))
-                qr_img_color = np.zeros((qr_img.shape[0], qr_img.shape[1], 3))
-                qr_img_color[:,:,0] = qr_img*255.
-                qr_img_color[:,:,1] = qr_img*255.
-                qr_img_color[:,:,2] = qr_img*255.
-                
-                img[:qr_img.shape[0], -qr_img.shape[1]:, :3] = qr_img_color
-                img = Image.fromarray(img)
-                img.save(out)
-
+        out_array = get_paper_ecg(input_file=filename,header_file=header, configs=configs, mask_unplotted_samples=args.mask_unplotted_samples, start_index=args.start_index, store_configs=args.store_config, store_text_bbox=text_bbox, store_plotted_pixels=plotted_pixels, output_directory=args.output_directory,resolution=plan['resolution'],papersize=papersize,add_lead_names=lead,add_dc_pulse=None,add_bw=None,show_grid=None,add_print=None,pad_inches=plan['pad_inches'],font_type=font,standard_colours=get_standard_colours(args),full_mode=args.full_mode,bbox = lead_bbox, columns = args.num_columns, seed=args.seed, image_plans=plan['images'], image_extension=IMAGE_EXTENSIONS[args.image_format], writer=context.writer, write_record=not context.sink.bundles_records, grid_cache=context.grid_cache, renderer=args.renderer, figure_pool=context.figure_pool, decimate_traces=args.decimate_traces, image_callback=lambda i, out, image, json_dict, record: process_ecg_image(args, context, out, image, json_dict, record, plan['images'][i], output_files))
 
         return len(out_array)
 
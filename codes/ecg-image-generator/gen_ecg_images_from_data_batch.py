@@ -1,8 +1,17 @@
 import os, sys, argparse
 import random
 import csv
-from helper_functions import find_records
+import copy
+import itertools
+import multiprocessing
+import multiprocessing.util
+import threading
+from helper_functions import iter_records, get_record_seed, set_random_seed, append_manifest_entry, read_manifest, get_shard
 from gen_ecg_image_from_data import run_single_file
+from worker_context import WorkerContext
+from profiling import stage, set_stage_record, StageRecorder, summarize_stage_timings, print_stage_summary
+from job_plan import plan_record, write_plan_entry, read_plan
+from output_sinks import TarShardSink, HDF5ShardSink, import_h5py
 import warnings
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2' 
@@ -16,6 +25,16 @@ def get_parser():
     parser.add_argument('--num_leads',type=str,default='twelve')
     parser.add_argument('--max_num_images',type=int,default = -1)
     parser.add_argument('--config_file', type=str, default='config.yaml')
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--writer_threads', type=int, default=2)
+    parser.add_argument('--output_sink', type=str, default='files', choices=['files', 'tar', 'hdf5'])
+    parser.add_argument('--output_shard_size', type=int, default=1024)
+    parser.add_argument('--resume', action='store_true', default=False)
+    parser.add_argument('--shard_index', type=int, default=0)
+    parser.add_argument('--num_shards', type=int, default=1)
+    parser.add_argument('--stage_timings', action='store_true', default=False)
+    parser.add_argument('--write_plan', type=str, default=None)
+    parser.add_argument('--plan_file', type=str, default=None)
     
     parser.add_argument('-r','--resolution',type=int,required=False,default = 200)
     parser.add_argument('--pad_inches',type=int,required=False,default=0)
@@ -24,6 +43,16 @@ def get_parser():
     parser.add_argument('--full_mode', type=str,default='II')
     parser.add_argument('--mask_unplotted_samples', action="store_true", default=False)
     parser.add_argument('--add_qr_code', action="store_true", default=False)
+    parser.add_argument('--image_format', type=str, default='png', choices=['png', 'jpeg', 'webp', 'npy'])
+    parser.add_argument('--png_compression', type=int, default=6)
+    parser.add_argument('--image_quality', type=int, default=90)
+    parser.add_argument('--annotation_format', type=str, default='json', choices=['json', 'npz'])
+    parser.add_argument('--annotation_level', type=str, default=None, choices=['none', 'boxes', 'pixels', 'full'])
+    parser.add_argument('--grid_cache_mb', type=int, default=0)
+    parser.add_argument('--grid_palette_size', type=int, default=64)
+    parser.add_argument('--renderer', type=str, default='matplotlib', choices=['matplotlib', 'raster'])
+    parser.add_argument('--decimate_traces', action='store_true', default=False)
+    parser.add_argument('--output_resolutions', type=int, nargs='+', default=None)
 
     parser.add_argument('-l', '--link', type=str, required=False,default='')
     parser.add_argument('-n','--num_words',type=int,required=False,default=5)
@@ -73,6 +102,154 @@ def get_parser():
 
     return parser
 
+# Size of the recording on disk, used as a proxy for the cost of rendering it
+def get_record_size(input_directory, recording_file):
+    try:
+        return os.path.getsize(os.path.join(input_directory, recording_file))
+    except OSError:
+        return 0
+
+#Reorder records longest first within consecutive windows, so that discovery can keep streaming
+def schedule_longest_first(records, input_directory, window):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == window:
+            yield from sorted(batch, key=lambda record: get_record_size(input_directory, record[1]), reverse=True)
+            batch = []
+    yield from sorted(batch, key=lambda record: get_record_size(input_directory, record[1]), reverse=True)
+
+#Options of one record, derived from the options of the batch
+def get_record_args(args, original_output_dir, full_header_file, full_recording_file):
+    args = copy.copy(args)
+    filename = full_recording_file
+    header = full_header_file
+    args.input_file = os.path.join(args.input_directory, filename)
+    args.header_file = os.path.join(args.input_directory, header)
+    args.start_index = -1
+
+    folder_struct_list = full_header_file.split('/')[:-1]
+    args.output_directory = os.path.join(original_output_dir, '/'.join(folder_struct_list))
+    args.encoding = os.path.split(os.path.splitext(filename)[0])[1]
+    return args
+
+#Sample the job plan of one record, seeded independently of the other records so that it does not depend on the processing order
+def plan_record_entry(args, original_output_dir, full_header_file, full_recording_file, context):
+    args = get_record_args(args, original_output_dir, full_header_file, full_recording_file)
+    record_seed = get_record_seed(args.seed, full_recording_file)
+    set_random_seed(record_seed)
+
+    entry = {'record': full_recording_file, 'header': full_header_file, 'seed': record_seed}
+    entry.update(plan_record(args, context))
+    return entry
+
+def run_record(args, original_output_dir, full_header_file, full_recording_file, manifest_file, context, plan=None):
+    if plan is None:
+        plan = plan_record_entry(args, original_output_dir, full_header_file, full_recording_file, context)
+    args = get_record_args(args, original_output_dir, full_header_file, full_recording_file)
+    if context.sink.bundles_records == False:
+        os.makedirs(args.output_directory, exist_ok=True)
+    record_seed = plan['seed']
+
+    entry = {'record': full_recording_file, 'seed': record_seed, 'status': 'started', 'outputs': []}
+    append_manifest_entry(manifest_file, entry)
+
+    output_files = []
+    set_stage_record(full_recording_file)
+    with stage('record'):
+        num_images = run_single_file(args, output_files, context, plan)
+
+    if context.sink.bundles_records == False:
+        record_name = os.path.splitext(os.path.split(full_header_file)[1])[0]
+        output_files.append(os.path.join(args.output_directory, record_name + '.hea'))
+        output_files.append(os.path.join(args.output_directory, record_name + '.dat'))
+
+    #The record is only marked done once all of its outputs have been written, and committed by the sink
+    entry['status'] = 'done'
+    entry['num_images'] = num_images
+    entry['outputs'] = [os.path.relpath(f, original_output_dir) for f in output_files]
+    context.writer.call_after_pending(lambda: context.sink.call_after_commit(lambda: append_manifest_entry(manifest_file, entry)))
+
+    return num_images
+
+images_generated = None
+worker_flush_barrier = None
+worker_context = None
+stage_recorder = None
+
+#Number of discovered records reordered together when scheduling parallel runs
+SCHEDULING_WINDOW = 1024
+
+#Each process writing tar or HDF5 shards owns its own stream of shards
+def set_shard_sink(context, args, original_output_dir, worker_index):
+    if args.num_shards > 1:
+        stream = '{}of{}-{:03d}'.format(args.shard_index, args.num_shards, worker_index)
+    else:
+        stream = '{:03d}'.format(worker_index)
+    if args.output_sink == 'tar':
+        context.sink = TarShardSink(original_output_dir, stream, args.output_shard_size*1024*1024)
+    else:
+        context.sink = HDF5ShardSink(original_output_dir, stream, args.output_shard_size*1024*1024)
+
+def init_worker(counter, flush_barrier, config_file, timings_file, writer_threads, worker_indices, args, original_output_dir):
+    global images_generated, worker_flush_barrier, worker_context, stage_recorder
+    images_generated = counter
+    worker_flush_barrier = flush_barrier
+    worker_context = WorkerContext(config_file, writer_threads, args.grid_cache_mb)
+    if args.output_sink != 'files':
+        with worker_indices.get_lock():
+            worker_index = worker_indices.value
+            worker_indices.value += 1
+        set_shard_sink(worker_context, args, original_output_dir, worker_index)
+    #Close the last shard of the worker when the pool shuts down without flushing it, e.g. after a failed write
+    multiprocessing.util.Finalize(worker_context, worker_context.close, exitpriority=10)
+    if timings_file is not None:
+        stage_recorder = StageRecorder(timings_file)
+
+def run_record_worker(job):
+    args, original_output_dir, full_header_file, full_recording_file, manifest_file, plan = job
+
+    #The images of a record are reserved before it is rendered, so that the records in flight in other
+    #workers count towards --max_num_images and no record is started once the limit is reached
+    reserved = 0
+    if args.max_num_images != -1:
+        if images_generated.value >= args.max_num_images:
+            return 0
+        if plan is None:
+            plan = plan_record_entry(args, original_output_dir, full_header_file, full_recording_file, worker_context)
+        with images_generated.get_lock():
+            if images_generated.value >= args.max_num_images:
+                return 0
+            reserved = len(plan['images'])
+            images_generated.value += reserved
+
+    num_images = run_record(args, original_output_dir, full_header_file, full_recording_file, manifest_file, worker_context, plan)
+    #The writes of the record continue while the worker renders the next one, errors of the writes completed so far are raised here
+    worker_context.writer.raise_errors()
+
+    with images_generated.get_lock():
+        images_generated.value += num_images - reserved
+    return num_images
+
+#Wait for the outputs still being written by a worker and close its last shard, raising any write error in the
+#parent. One flush job is sent per worker: each waits on the barrier after its flush, so no worker takes two of them
+def flush_worker(index):
+    try:
+        worker_context.writer.flush()
+        worker_context.close()
+    finally:
+        worker_flush_barrier.wait()
+    return 0
+
+#Jobs of the pool, each taking one of the slots freed as the parent receives results. Once the workers have
+#reserved --max_num_images images no more records are read, so a small limit does not queue the whole input directory
+def iter_jobs(records, args, original_output_dir, manifest_file, counter, slots, stopped):
+    for full_header_file, full_recording_file, plan in records:
+        slots.acquire()
+        if stopped.is_set() or (args.max_num_images != -1 and counter.value >= args.max_num_images):
+            return
+        yield (args, original_output_dir, full_header_file, full_recording_file, manifest_file, plan)
+
 def run(args):
         random.seed(args.seed)
 
@@ -89,24 +266,124 @@ def run(args):
         if os.path.exists(original_output_dir) == False:
             os.makedirs(original_output_dir)
 
+        #Fail before starting the workers, which would otherwise each fail to create their sink
+        if args.output_sink == 'hdf5':
+            import_h5py()
+
         i = 0
-        full_header_files, full_recording_files = find_records(args.input_directory, original_output_dir)
-        
-        for full_header_file, full_recording_file in zip(full_header_files, full_recording_files):
-            filename = full_recording_file
-            header = full_header_file
-            args.input_file = os.path.join(args.input_directory, filename)
-            args.header_file = os.path.join(args.input_directory, header)
-            args.start_index = -1
-            
-            folder_struct_list = full_header_file.split('/')[:-1]
-            args.output_directory = os.path.join(original_output_dir, '/'.join(folder_struct_list))
-            args.encoding = os.path.split(os.path.splitext(filename)[0])[1]
-            
-            i += run_single_file(args)
-            
-            if(args.max_num_images != -1 and i >= args.max_num_images):
-                break
+        config_file = os.path.join(os.getcwd(), args.config_file)
+
+        #Records come with their job plan when replaying a plan file, otherwise they are planned right before they are generated
+        if args.plan_file is not None:
+            records = ((entry['header'], entry['record'], entry) for entry in read_plan(args.plan_file))
+        else:
+            records = ((full_header_file, full_recording_file, None) for full_header_file, full_recording_file in iter_records(args.input_directory, exclude_dir=original_output_dir))
+        first_record = next(records, None)
+        if first_record is None:
+            raise Exception("The input directory does not have any WFDB compatible ECG files, please re-check the folder!")
+        records = itertools.chain([first_record], records)
+
+        #Planning phase only: sample the parameters of every image and write them as one JSONL row per record
+        if args.write_plan is not None:
+            context = WorkerContext(config_file)
+            try:
+                with open(args.write_plan, 'w') as f:
+                    for full_header_file, full_recording_file, plan in records:
+                        write_plan_entry(f, plan_record_entry(args, original_output_dir, full_header_file, full_recording_file, context))
+                        i += 1
+            finally:
+                context.close()
+            return i
+
+        #Each node generates a disjoint subset of the records, balanced by recording size
+        if args.num_shards > 1:
+            records = list(records)
+            record_sizes = [get_record_size(args.input_directory, record[1]) for record in records]
+            records = get_shard(records, record_sizes, args.shard_index, args.num_shards)
+            manifest_file = os.path.join(original_output_dir, 'manifest-{}-of-{}.jsonl'.format(args.shard_index, args.num_shards))
+        else:
+            manifest_file = os.path.join(original_output_dir, 'manifest.jsonl')
+
+        #Records that completed in a previous run are skipped, records that were only started are generated again
+        if args.resume:
+            manifest = read_manifest(manifest_file)
+            done = set(record for record in manifest if manifest[record]['status'] == 'done')
+            i = sum(manifest[record]['num_images'] for record in done)
+            records = (record for record in records if record[1] not in done)
+
+            #Terminate a line left truncated by an interrupted run so that new entries start on their own line
+            if os.path.isfile(manifest_file) and os.path.getsize(manifest_file) > 0:
+                with open(manifest_file, 'rb+') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        f.write(b'\n')
+
+        #Per-stage timings of every record are appended to a JSONL file and summarized at the end
+        timings_file = None
+        if args.stage_timings:
+            timings_file = os.path.join(original_output_dir, 'stage_timings.jsonl')
+            if args.resume == False and os.path.isfile(timings_file):
+                os.remove(timings_file)
+
+        if args.num_workers <= 1:
+            global stage_recorder
+            context = WorkerContext(config_file, args.writer_threads, args.grid_cache_mb)
+            if args.output_sink != 'files':
+                set_shard_sink(context, args, original_output_dir, 0)
+            if timings_file is not None:
+                stage_recorder = StageRecorder(timings_file)
+            try:
+                for full_header_file, full_recording_file, plan in records:
+                    if(args.max_num_images != -1 and i >= args.max_num_images):
+                        break
+
+                    i += run_record(args, original_output_dir, full_header_file, full_recording_file, manifest_file, context, plan)
+                    #The writes of the record continue while the next one is rendered, errors of the writes completed so far are raised here
+                    context.writer.raise_errors()
+
+                #Wait for the outputs still being written and raise any write error
+                context.writer.flush()
+            finally:
+                context.close()
+                if stage_recorder is not None:
+                    stage_recorder.close()
+                    stage_recorder = None
+        else:
+            #Schedule the longest records first so that a single long record does not stall the end of the run.
+            #Sharded runs already hold the full record list, filtered by --resume, streamed runs are reordered within a window.
+            if args.num_shards > 1:
+                records = list(records)
+                records = schedule_longest_first(records, args.input_directory, len(records))
+            else:
+                records = schedule_longest_first(records, args.input_directory, SCHEDULING_WINDOW)
+            counter = multiprocessing.Value('i', i)
+            worker_indices = multiprocessing.Value('i', 0)
+            #The pool reads the jobs on its own thread, which waits for a slot freed by every result received below
+            slots = threading.Semaphore(2*args.num_workers)
+            stopped = threading.Event()
+            jobs = iter_jobs(records, args, original_output_dir, manifest_file, counter, slots, stopped)
+
+            flush_barrier = multiprocessing.Barrier(args.num_workers)
+            pool = multiprocessing.Pool(args.num_workers, initializer=init_worker, initargs=(counter, flush_barrier, config_file, timings_file, args.writer_threads, worker_indices, args, original_output_dir))
+            try:
+                for num_images in pool.imap_unordered(run_record_worker, jobs, chunksize=1):
+                    i += num_images
+                    slots.release()
+                pool.map(flush_worker, range(args.num_workers), chunksize=1)
+                pool.close()
+            except:
+                #Unblock the job thread so that the pool can be terminated
+                stopped.set()
+                slots.release()
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        if timings_file is not None and os.path.isfile(timings_file):
+            print_stage_summary(summarize_stage_timings(timings_file))
+
+        return i
 
 if __name__=='__main__':
     path = os.path.join(os.getcwd(), sys.argv[0])
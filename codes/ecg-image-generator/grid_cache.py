@@ -0,0 +1,37 @@
+import numpy as np
+from lru_cache import LRUCache
+
+class GridBackgroundCache:
+    """Rendered grid backgrounds, evicted least recently used first once over a memory budget
+
+    The grid of an ECG page depends only on the page size, the resolution, whether the
+    grid is shown and its colour pair, so it is rendered once per distinct key and the
+    traces and text of every image are composited over a copy of it.
+
+    Args:
+        max_bytes (int): Memory budget of the cached backgrounds
+    """
+    def __init__(self, max_bytes):
+        self.backgrounds = LRUCache(max_size=max_bytes, size=lambda background: background.nbytes)
+
+    def get(self, key, render):
+        """Return the background of key, rendered by render() when it is not cached
+
+        The returned array is shared with later calls and must not be modified.
+        """
+        def render_background():
+            background = render()
+            background.setflags(write=False)
+            return background
+        return self.backgrounds.get(key, render_background)
+
+#Alpha-blend a rendered RGBA foreground with straight alpha over an opaque RGBA background of the same size.
+#Only the few pixels covered by traces and text are blended, the rest is a copy of the background.
+def composite_over_background(foreground, background):
+    image = background.copy()
+    covered = np.flatnonzero(foreground[:, :, 3])
+    pixels = foreground.reshape(-1, 4)[covered]
+    alpha = pixels[:, 3:4].astype(np.uint16)
+    blended = image.reshape(-1, 4)
+    blended[covered, :3] = (pixels[:, :3]*alpha + blended[covered, :3]*(255 - alpha) + 127)//255
+    return image
@@ -1,10 +1,14 @@
 import os, sys, argparse, yaml, math
+import random
+import hashlib
+import json
 import numpy as np
 from scipy.io import savemat, loadmat
 import matplotlib.pyplot as plt
 from matplotlib.ticker import AutoMinorLocator
 from math import ceil 
 import wfdb
+import imgaug as ia
 from imgaug import augmenters as iaa
 
 BIT_NAN_16 = -(2.**15)
@@ -27,24 +31,134 @@ def read_config_file(config_file):
 
     return args
 
-def find_records(folder, output_dir):
-    header_files = list()
-    recording_files = list()
+def get_record_seed(seed, record):
+    """Derive a deterministic seed for a single record
+
+    Args:
+        seed (int): Global seed passed on the command line
+        record (str): Path of the recording file relative to the input directory
+
+    Returns:
+        record_seed (int): Seed in the range accepted by numpy, depending only on seed and record
+    """
+    digest = hashlib.sha256('{}:{}'.format(seed, record).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16)
+
+def set_random_seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    ia.seed(seed)
+
+#Serialize the numpy arrays kept in the annotations, e.g. the plotted pixels, with json.dumps(..., default=json_default)
+def json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('Object of type ' + type(value).__name__ + ' is not JSON serializable')
+
+def append_manifest_entry(manifest_file, entry):
+    """Append a single entry to the JSONL completion manifest
 
+    The line is written with a single call on a file opened in append mode so that
+    concurrent workers never interleave partial entries.
+
+    Args:
+        manifest_file (str): Complete path to the manifest file
+        entry (dict): Entry to append
+    """
+    line = (json.dumps(entry) + '\n').encode('utf-8')
+    fd = os.open(manifest_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read_manifest(manifest_file):
+    """Read the JSONL completion manifest
+
+    Args:
+        manifest_file (str): Complete path to the manifest file
+
+    Returns:
+        entries (dict): Last entry written for every record, keyed by record
+    """
+    entries = dict()
+    if os.path.isfile(manifest_file) == False:
+        return entries
+
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                #Skip lines truncated by an interrupted run
+                continue
+            entries[entry['record']] = entry
+
+    return entries
+
+def get_shard(records, record_sizes, shard_index, num_shards):
+    """Select the records belonging to one shard
+
+    Records are assigned greedily, largest first, to the shard with the smallest total size
+    so far, which gives shards of roughly equal cost. The assignment depends only on the
+    records and their sizes, so every node computes the same split.
+
+    Args:
+        records (list): Records to split, as (header, recording) tuples
+        record_sizes (list): Size of each record in bytes
+        shard_index (int): Index of the shard to return, in the range [0, num_shards)
+        num_shards (int): Total number of shards
+
+    Returns:
+        shard (list): Records assigned to shard_index, in their original order
+    """
+    if num_shards < 1 or shard_index < 0 or shard_index >= num_shards:
+        raise Exception("The shard index must be in the range [0, num_shards), please re-check the input arguments!")
+
+    order = sorted(range(len(records)), key=lambda k: (-record_sizes[k], records[k][1]))
+    shard_sizes = [0] * num_shards
+    selected = set()
+    for k in order:
+        shard = shard_sizes.index(min(shard_sizes))
+        shard_sizes[shard] += record_sizes[k]
+        if shard == shard_index:
+            selected.add(k)
+
+    return [records[k] for k in range(len(records)) if k in selected]
+
+def iter_records(folder, exclude_dir=None):
+    """Lazily discover WFDB records under a folder
+
+    Directories are walked in sorted order and every record is yielded as soon as it is
+    found, so that generation can start before the whole tree has been listed.
+
+    Args:
+        folder (str): Root folder to search
+        exclude_dir (str): Optional directory that is not descended into, e.g. an output directory inside folder
+
+    Yields:
+        (header_file, recording_file) (tuple): Paths relative to folder
+    """
     for root, directories, files in os.walk(folder):
+        directories[:] = [d for d in sorted(directories) if os.path.join(root, d) != exclude_dir]
         files = sorted(files)
         for file in files:
             extension = os.path.splitext(file)[1]
-            if extension == '.mat':
-                record = os.path.relpath(os.path.join(root, file.split('.')[0] + '.mat'), folder)
-                hd = os.path.relpath(os.path.join(root, file.split('.')[0] + '.hea'), folder)
-                recording_files.append(record)
-                header_files.append(hd)
-            if extension == '.dat':
-                record = os.path.relpath(os.path.join(root, file.split('.')[0] + '.dat'), folder)
+            if extension == '.mat' or extension == '.dat':
+                record = os.path.relpath(os.path.join(root, file.split('.')[0] + extension), folder)
                 hd = os.path.relpath(os.path.join(root, file.split('.')[0] + '.hea'), folder)
-                header_files.append(hd)
-                recording_files.append(record)
+                yield hd, record
+
+def find_records(folder, output_dir):
+    header_files = list()
+    recording_files = list()
+
+    for hd, record in iter_records(folder):
+        header_files.append(hd)
+        recording_files.append(record)
     
     if recording_files == []:
         raise Exception("The input directory does not have any WFDB compatible ECG files, please re-check the folder!")
@@ -158,6 +272,19 @@ def get_frequency(header):
             break
     return frequency
 
+# Get the number of samples per lead from header.
+def get_num_samples(header):
+    num_samples = None
+    for i, l in enumerate(header.split('\n')):
+        if i==0:
+            try:
+                num_samples = int(l.split(' ')[3])
+            except:
+                pass
+        else:
+            break
+    return num_samples
+
 # Get analog-to-digital converter (ADC) gains from header.
 def get_adc_gains(header, leads):
     adc_gains = np.zeros(len(leads))
@@ -237,11 +364,12 @@ def read_leads(leads):
         startTimeStamps.append(st_time_stamp)
         end_time_stamp = leads[i]['end_sample']
         endTimeStamps.append(end_time_stamp)
-        plotted_pixels.append(leads[i]['plotted_pixels'])
+        plotted_pixels.append(leads[i].get('plotted_pixels'))
 
+        #Corners are keyed by integers in memory and by strings once loaded from JSON
         key = "lead_bounding_box"
         if key in leads[i].keys():
-            parts = leads[i][key]
+            parts = {str(k): v for k, v in leads[i][key].items()}
             point1 = [parts['0'][0], parts['0'][1]]
             point2 = [parts['1'][0], parts['1'][1]]
             point3 = [parts['2'][0], parts['2'][1]]
@@ -251,7 +379,7 @@ def read_leads(leads):
 
         key = "text_bounding_box"
         if key in leads[i].keys():
-            parts = leads[i][key]
+            parts = {str(k): v for k, v in leads[i][key].items()}
             point1 = [parts['0'][0], parts['0'][1]]
             point2 = [parts['1'][0], parts['1'][1]]
             point3 = [parts['2'][0], parts['2'][1]]
@@ -292,12 +420,37 @@ def convert_bounding_boxes_to_dict(lead_bboxes, text_bboxes, labels, startTimeLi
         current_lead_ds["lead_name"] = labels[i]
         current_lead_ds["start_sample"] = startTimeList[i]
         current_lead_ds["end_sample"] = endTimeList[i]
-        current_lead_ds["plotted_pixels"] = [[plotted_pixels_dict[i][j][0], plotted_pixels_dict[i][j][1]] for j in range(len(plotted_pixels_dict[i]))]
+        if plotted_pixels_dict is not None:
+            current_lead_ds["plotted_pixels"] = np.asarray(plotted_pixels_dict[i])
         leads_ds.append(current_lead_ds)
 
     return leads_ds
 
 
+#Copy of the annotations of an image resized by scale_x and scale_y, with the pixel coordinates of the
+#page size, grid, bounding boxes and plotted pixels scaled to the resized image
+def scale_annotations(json_dict, scale_x, scale_y):
+    scaled = dict(json_dict)
+    for key, scale in (('width', scale_x), ('height', scale_y)):
+        if key in scaled:
+            scaled[key] = int(round(scaled[key]*scale))
+    for key, scale in (('x_grid', scale_x), ('y_grid', scale_y)):
+        if key in scaled:
+            scaled[key] = round(scaled[key]*scale, 3)
+    if 'leads' not in json_dict:
+        return scaled
+
+    scaled['leads'] = []
+    for lead in json_dict['leads']:
+        scaled_lead = dict(lead)
+        for key in ('lead_bounding_box', 'text_bounding_box'):
+            if key in lead:
+                scaled_lead[key] = {k: [round(y*scale_y, 2), round(x*scale_x, 2)] for k, (y, x) in lead[key].items()}
+        if lead.get('plotted_pixels') is not None:
+            scaled_lead['plotted_pixels'] = np.round(np.asarray(lead['plotted_pixels'], dtype=float).reshape(-1, 2)*[scale_y, scale_x], 2)
+        scaled['leads'].append(scaled_lead)
+    return scaled
+
 def convert_mm_to_volts(mm):
     return float(mm/10)
 
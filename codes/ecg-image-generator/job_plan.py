@@ -0,0 +1,142 @@
+import os
+import json
+import random
+from helper_functions import load_header, load_recording, get_leads, get_frequency, get_num_samples
+from ecg_plot import sample_grid_colours
+
+#Colour scheme of the grid: a standard colour index, -1 for random colours or False when black and white pages are sampled
+def get_standard_colours(args):
+    if(args.random_bw == 0):
+        if args.random_grid_color == False:
+            return args.standard_grid_color
+        else:
+            return -1
+    else:
+        return False
+
+#Random grid colours are drawn from a fixed palette when grid backgrounds are cached, to bound the number of cached grids
+def get_grid_palette_size(args):
+    return args.grid_palette_size if args.grid_cache_mb > 0 else 0
+
+#Number of images get_paper_ecg renders from a record, one per abs_lead_step seconds of signal
+def get_num_images(args, configs):
+    if args.start_index != -1:
+        return 1
+
+    header = load_header(args.header_file)
+    rate = get_frequency(header)
+    num_samples = get_num_samples(header)
+    if num_samples is None:
+        num_leads = len(get_leads(header))
+        recording = load_recording(args.input_file, header)
+        num_samples = recording.shape[1] if recording.shape[0] == num_leads else recording.shape[0]
+
+    step = int(rate*configs['abs_lead_step'])
+    return num_samples // step
+
+def plan_image(args, standard_colours, wrinkle_files, palette_size=0):
+    """Sample every random choice made while generating one image
+
+    Args:
+        args (Namespace): Generator options
+        standard_colours (int): Grid colour scheme, see get_standard_colours
+        wrinkle_files (list): Names of the available wrinkle textures
+        palette_size (int): Size of the palette of random grid colours, see get_grid_palette_size
+
+    Returns:
+        image (dict): Parameters of the image. The seed drives the randomness left inside the
+            distortions, i.e. the handwritten words, the wrinkle quilting and the augmentation noise.
+    """
+    image = dict()
+    image['seed'] = random.getrandbits(32)
+    image['dc_pulse'] = random.random() < args.calibration_pulse
+    image['bw'] = random.random() < args.random_bw
+    image['gridlines'] = random.random() < args.random_grid_present
+    image['printed_text'] = True if args.print_header else random.random() < args.random_print_header
+    image['grid_colours'] = [list(c) for c in sample_grid_colours('bw' if image['bw'] else 'colour', standard_colours, palette_size)]
+
+    if(args.fully_random):
+        image['hw_text'] = random.choice((True,False))
+        image['wrinkles'] = random.choice((True,False))
+        image['augment'] = random.choice((True,False))
+    else:
+        image['hw_text'] = args.hw_text
+        image['wrinkles'] = args.wrinkles
+        image['augment'] = args.augment
+
+    if(image['hw_text']):
+        image['num_words'] = args.num_words if (args.deterministic_num_words) else random.choice(range(2,args.num_words+1))
+        image['x_offset'] = args.x_offset if (args.deterministic_offset) else random.choice(range(1,args.x_offset+1))
+        image['y_offset'] = args.y_offset if (args.deterministic_offset) else random.choice(range(1,args.y_offset+1))
+    else:
+        image['num_words'] = 0
+        image['x_offset'] = 0
+        image['y_offset'] = 0
+
+    if(image['wrinkles']):
+        image['crease_angle'] = args.crease_angle if (args.deterministic_angle) else random.choice(range(0,args.crease_angle+1))
+        image['num_creases_vertically'] = args.num_creases_vertically if (args.deterministic_vertical) else random.choice(range(1,args.num_creases_vertically+1))
+        image['num_creases_horizontally'] = args.num_creases_horizontally if (args.deterministic_horizontal) else random.choice(range(1,args.num_creases_horizontally+1))
+        image['wrinkle_texture'] = random.choice(wrinkle_files)
+    else:
+        image['crease_angle'] = 0
+        image['num_creases_vertically'] = 0
+        image['num_creases_horizontally'] = 0
+        image['wrinkle_texture'] = None
+
+    if(image['augment']):
+        image['noise'] = args.noise if (args.deterministic_noise) else random.choice(range(1,args.noise+1))
+        image['crop'] = 0 if args.lead_bbox else args.crop
+        image['crop_sample'] = random.uniform(0, image['crop'])
+        if random.choice((True,False)):
+            image['temperature'] = random.choice(range(2000,4000))
+        else:
+            image['temperature'] = random.choice(range(10000,20000))
+        image['rotate'] = args.rotate
+        image['rot'] = random.randint(-args.rotate, args.rotate)
+    else:
+        image['noise'] = 0
+        image['crop'] = 0
+        image['crop_sample'] = 0
+        image['temperature'] = 0
+        image['rotate'] = 0
+        image['rot'] = 0
+
+    return image
+
+def plan_record(args, context):
+    """Sample the parameters of a record and of every image generated from it
+
+    Args:
+        args (Namespace): Generator options, with input_file, header_file and start_index set
+        context (WorkerContext): Provides the config, fonts and wrinkle textures
+
+    Returns:
+        plan (dict): Resolution, padding and font of the record and the list of image parameters
+    """
+    plan = dict()
+    if args.output_resolutions is not None:
+        #Every output resolution is downscaled from one render at the highest of them
+        if args.random_resolution:
+            raise Exception("--output_resolutions and --random_resolution cannot be combined, please re-check the input arguments!")
+        plan['resolution'] = max(args.output_resolutions)
+    else:
+        plan['resolution'] = random.choice(range(50,args.resolution+1)) if (args.random_resolution) else args.resolution
+    plan['pad_inches'] = random.choice(range(0,args.pad_inches+1)) if (args.random_padding) else args.pad_inches
+    plan['font'] = random.choice(context.fonts)
+
+    standard_colours = get_standard_colours(args)
+    num_images = get_num_images(args, context.configs)
+    plan['images'] = [plan_image(args, standard_colours, context.wrinkle_files, get_grid_palette_size(args)) for i in range(num_images)]
+    return plan
+
+#Write one plan row per line, so that plans of large datasets are streamed instead of held in memory
+def write_plan_entry(f, entry):
+    f.write(json.dumps(entry) + '\n')
+
+def read_plan(plan_file):
+    with open(plan_file, 'r') as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            yield json.loads(line)
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+
+class LRUCache:
+    """Values kept by key and evicted least recently used first
+
+    Shared by the per-process caches of the generator: the page figures, grid backgrounds,
+    fonts, text extents and sprites, and page layouts. A cache is bounded by a number of
+    values, a budget of their total size, or both. Values cannot be None.
+
+    Args:
+        max_entries (int): Number of values kept, None for no limit
+        max_size (int): Budget of the total size of the values, None for no limit
+        size (function): Size of a value, counted against max_size
+    """
+    def __init__(self, max_entries=None, max_size=None, size=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = size
+        self.values = OrderedDict()
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def lookup(self, key):
+        """Return the value of key and mark it as most recently used, None when it is not cached"""
+        if key in self.values:
+            self.values.move_to_end(key)
+            self.hits += 1
+            return self.values[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """Cache value under key, evicting the least recently used values once over the bounds, and return it"""
+        value_size = self.size(value) if self.max_size is not None else 0
+        #A value larger than the whole budget is used once and not cached
+        if self.max_size is not None and value_size > self.max_size:
+            return value
+
+        if key in self.values:
+            self.total_size -= self.size(self.values[key]) if self.max_size is not None else 0
+        self.values[key] = value
+        self.values.move_to_end(key)
+        self.total_size += value_size
+        while (self.max_entries is not None and len(self.values) > self.max_entries) or (self.max_size is not None and self.total_size > self.max_size):
+            evicted_key, evicted = self.values.popitem(last=False)
+            self.total_size -= self.size(evicted) if self.max_size is not None else 0
+        return value
+
+    def get(self, key, create):
+        """Return the value of key, created by create() and cached when it is not cached"""
+        value = self.lookup(key)
+        if value is None:
+            value = self.put(key, create())
+        return value
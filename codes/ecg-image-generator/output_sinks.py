@@ -0,0 +1,473 @@
+import os
+import io
+import json
+import time
+import tarfile
+import tempfile
+import bisect
+import struct
+import zipfile
+import threading
+import numpy as np
+from PIL import Image
+from helper_functions import json_default, write_wfdb_file, append_manifest_entry, load_header, get_leads, standardize_leads
+
+#File extension of every output image format
+IMAGE_EXTENSIONS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp', 'npy': '.npy'}
+
+def encode_image(image, image_format='png', png_compression=6, image_quality=90):
+    """Encode an RGB or RGBA image array in the given format
+
+    Args:
+        image (ndarray): Image of shape (height, width, channels) and type uint8
+        image_format (str): One of 'png', 'jpeg', 'webp' or 'npy'
+        png_compression (int): zlib compression level of PNG images, from 0 (none, fastest) to 9 (smallest)
+        image_quality (int): Quality of JPEG and WebP images, from 1 to 100
+
+    Returns:
+        data (bytes): Content of the image file. The generated pages are opaque, so the alpha
+            channel is dropped by the formats other than PNG.
+    """
+    buffer = io.BytesIO()
+    if image_format == 'png':
+        Image.fromarray(image).save(buffer, format='png', compress_level=png_compression)
+        return buffer.getvalue()
+
+    image = np.ascontiguousarray(image[:, :, :3])
+    if image_format == 'npy':
+        np.save(buffer, image)
+    elif image_format == 'jpeg':
+        Image.fromarray(image).save(buffer, format='jpeg', quality=image_quality)
+    elif image_format == 'webp':
+        Image.fromarray(image).save(buffer, format='webp', quality=image_quality)
+    else:
+        raise Exception("Unsupported image format " + image_format + ", please re-check the input arguments!")
+    return buffer.getvalue()
+
+def encode_json(json_dict):
+    return json.dumps(json_dict, indent=4, default=json_default).encode('utf-8')
+
+#Corners of a bounding box of the annotations as a (4, 2) array of (y, x), NaN when the box was not stored
+def get_box_corners(lead, key):
+    corners = np.full((4, 2), np.nan, dtype=np.float32)
+    if key in lead:
+        box = {str(k): v for k, v in lead[key].items()}
+        for k in range(4):
+            corners[k] = box[str(k)]
+    return corners
+
+def split_annotations(json_dict, arrays_file_name):
+    """Split the annotations into scalar metadata and the per-lead arrays of the npz sidecar
+
+    Args:
+        json_dict (dict): Annotations of one image
+        arrays_file_name (str): File name of the sidecar, referenced from the metadata
+
+    Returns:
+        metadata (dict): Annotations without the leads, with the lead names and the sidecar reference
+        arrays (dict): plotted_pixels (P, 2) float32 (y, x) of all the leads, concatenated, with
+            plotted_pixels_index (L, 2) int32 giving the first row and number of rows of every lead,
+            start_sample and end_sample (L,) int32, lead_bounding_box and text_bounding_box (L, 4, 2)
+            float32 (y, x) corners, NaN when not stored
+    """
+    leads = json_dict['leads']
+    metadata = {key: value for key, value in json_dict.items() if key != 'leads'}
+    metadata['lead_names'] = [lead['lead_name'] for lead in leads]
+    metadata['annotation_arrays'] = arrays_file_name
+
+    pixels = [np.asarray(lead.get('plotted_pixels', []), dtype=np.float32).reshape(-1, 2) for lead in leads]
+    counts = np.array([len(p) for p in pixels], dtype=np.int32)
+    arrays = dict()
+    arrays['plotted_pixels'] = np.concatenate(pixels) if pixels else np.zeros((0, 2), dtype=np.float32)
+    arrays['plotted_pixels_index'] = np.column_stack((np.cumsum(counts) - counts, counts)).astype(np.int32).reshape(-1, 2)
+    arrays['start_sample'] = np.array([lead['start_sample'] for lead in leads], dtype=np.int32)
+    arrays['end_sample'] = np.array([lead['end_sample'] for lead in leads], dtype=np.int32)
+    arrays['lead_bounding_box'] = np.array([get_box_corners(lead, 'lead_bounding_box') for lead in leads], dtype=np.float32).reshape(-1, 4, 2)
+    arrays['text_bounding_box'] = np.array([get_box_corners(lead, 'text_bounding_box') for lead in leads], dtype=np.float32).reshape(-1, 4, 2)
+    return metadata, arrays
+
+#Arrays are stored uncompressed, so that load_annotations can memory-map them
+def encode_npz(arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+def load_npz_arrays(npz_file, mmap_mode='r'):
+    """Load the arrays of an uncompressed npz file, memory-mapped unless mmap_mode is None"""
+    arrays = dict()
+    with zipfile.ZipFile(npz_file) as z, open(npz_file, 'rb') as f:
+        for info in z.infolist():
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            if mmap_mode is None or info.compress_type != zipfile.ZIP_STORED:
+                with z.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            #The member data follows its local file header, which starts with 30 fixed bytes
+            f.seek(info.header_offset)
+            name_length, extra_length = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(npz_file, dtype=dtype, mode=mmap_mode, offset=f.tell(), shape=shape, order='F' if fortran_order else 'C')
+    return arrays
+
+def load_annotations(json_file, mmap_mode='r'):
+    """Load the annotations of one image, from JSON alone or from JSON with an npz sidecar
+
+    Returns:
+        annotations (dict): The JSON annotations. With a sidecar, its arrays (see split_annotations)
+            are added under their names, memory-mapped unless mmap_mode is None.
+    """
+    with open(json_file, 'r') as f:
+        annotations = json.load(f)
+    if 'annotation_arrays' in annotations:
+        annotations.update(load_npz_arrays(os.path.join(os.path.dirname(json_file), annotations['annotation_arrays']), mmap_mode))
+    return annotations
+
+#Encode the segmented WFDB record of get_paper_ecg under a new record name, returns its header and signal files
+def encode_wfdb_record(record, record_file):
+    head, record_name = os.path.split(record_file)
+    with tempfile.TemporaryDirectory() as write_dir:
+        write_wfdb_file(record['ecg_frame'], os.path.join(write_dir, record_name), record['rate'], record['header_file'], write_dir, record['full_mode'], record['mask_unplotted_samples'])
+        files = []
+        for extension in ('.hea', '.dat'):
+            with open(os.path.join(write_dir, record_name + extension), 'rb') as f:
+                files.append((record_file + extension, f.read()))
+    return files
+
+class FileSink:
+    """Write every output as its own file"""
+    bundles_records = False
+
+    def write_sample(self, image_file, image, image_options, json_file=None, json_dict=None, record=None, annotation_format='json'):
+        """Write task handed to OutputWriter.submit: encode one image with its annotations and write the files
+
+        Args:
+            image_file (str): Complete path of the image, its extension gives the key of the sample
+            image (ndarray): Image to encode
+            image_options (tuple): Format, PNG compression and quality passed to encode_image
+            json_file (str): Complete path of the JSON annotations, None to skip them
+            json_dict (dict): Annotations of the image
+            record (dict): Segmented WFDB record of get_paper_ecg, written with the sample when given
+            annotation_format (str): 'json' writes all the annotations as JSON, 'npz' writes the per-lead
+                arrays to an npz sidecar next to the JSON file, which keeps the scalar metadata
+        """
+        files = [(image_file, encode_image(image, *image_options))]
+        if json_file is not None and annotation_format == 'npz':
+            arrays_file = os.path.splitext(json_file)[0] + '.npz'
+            metadata, arrays = split_annotations(json_dict, os.path.basename(arrays_file))
+            files.append((json_file, encode_json(metadata)))
+            files.append((arrays_file, encode_npz(arrays)))
+        elif json_file is not None:
+            files.append((json_file, encode_json(json_dict)))
+        if record is not None:
+            files += encode_wfdb_record(record, os.path.splitext(image_file)[0])
+        self.write(files)
+
+    def write(self, files):
+        for output_file, data in files:
+            with open(output_file, 'wb') as f:
+                f.write(data)
+
+    def call_after_commit(self, fn):
+        fn()
+
+    def close(self):
+        pass
+
+class ShardSink(FileSink):
+    """Base of the sinks appending samples to rolling shard files
+
+    A shard is closed once it reaches max_shard_size bytes and a line with its name, size and
+    sample keys is appended to the index file of the sink. Shards missing from the index were
+    interrupted and are incomplete.
+
+    Args:
+        output_directory (str): Directory of the shards, sample keys are relative to it
+        stream (str): Name of the shard stream, unique per process writing to the directory
+        max_shard_size (int): Size in bytes after which a shard is closed
+    """
+    bundles_records = True
+    extension = None
+    index_name = None
+
+    def __init__(self, output_directory, stream, max_shard_size):
+        self.output_directory = output_directory
+        self.stream = stream
+        self.max_shard_size = max_shard_size
+        self.index_file = os.path.join(output_directory, self.index_name)
+        self.lock = threading.Lock()
+        self.next_shard = 0
+        self.shard_name = None
+
+    def open_shard(self):
+        #Never overwrite the shards of a previous run, e.g. when resuming
+        while True:
+            self.shard_name = 'samples-{}-{:06d}{}'.format(self.stream, self.next_shard, self.extension)
+            self.next_shard += 1
+            try:
+                shard_file = open(os.path.join(self.output_directory, self.shard_name), 'xb')
+                break
+            except FileExistsError:
+                continue
+        self.keys = []
+        self.callbacks = []
+        self.start_shard(shard_file)
+
+    def close_shard(self):
+        self.finish_shard()
+        size = os.path.getsize(os.path.join(self.output_directory, self.shard_name))
+        append_manifest_entry(self.index_file, {'shard': self.shard_name, 'size': size, 'num_samples': len(self.keys), 'keys': self.keys})
+        self.shard_name = None
+        for fn in self.callbacks:
+            fn()
+
+    def add_sample(self, key, add):
+        with self.lock:
+            if self.shard_name is None:
+                self.open_shard()
+            self.keys.append(key)
+            add()
+            if self.shard_size() >= self.max_shard_size:
+                self.close_shard()
+
+    def sample_key(self, output_file):
+        return os.path.splitext(os.path.relpath(output_file, self.output_directory))[0]
+
+    def call_after_commit(self, fn):
+        """Call fn once the samples written so far are in a shard listed in the index"""
+        with self.lock:
+            if self.shard_name is not None:
+                self.callbacks.append(fn)
+                return
+        fn()
+
+    def close(self):
+        with self.lock:
+            if self.shard_name is not None:
+                self.close_shard()
+
+class TarShardSink(ShardSink):
+    """Append samples to rolling tar shards, in the layout read by WebDataset
+
+    All the files of a sample share the key of the image, e.g. a/r1-0.png, a/r1-0.json,
+    a/r1-0.hea and a/r1-0.dat, and are stored next to each other. Completed shards are listed
+    in tar_index.jsonl.
+    """
+    extension = '.tar'
+    index_name = 'tar_index.jsonl'
+
+    def start_shard(self, shard_file):
+        self.shard_file = shard_file
+        self.tar = tarfile.open(fileobj=shard_file, mode='w')
+
+    def finish_shard(self):
+        self.tar.close()
+        self.shard_file.close()
+
+    def shard_size(self):
+        return self.shard_file.tell()
+
+    def write(self, files):
+        def add():
+            for output_file, data in files:
+                info = tarfile.TarInfo(os.path.relpath(output_file, self.output_directory))
+                info.size = len(data)
+                info.mtime = int(time.time())
+                self.tar.addfile(info, io.BytesIO(data))
+        self.add_sample(self.sample_key(files[0][0]), add)
+
+#gzip level of the HDF5 datasets, and number of elements per chunk of the flat ragged datasets
+HDF5_COMPRESSION_LEVEL = 4
+HDF5_CHUNK_SIZE = 1 << 20
+
+#Segmented signal of a record as a (leads, samples) array in physical units, in the lead order of write_wfdb_file
+def get_record_signal(record):
+    leads = standardize_leads(get_leads(load_header(record['header_file'])))
+    rows = []
+    for lead in leads:
+        key = 'full' + lead if lead == record['full_mode'] else lead
+        rows.append(np.asarray(record['ecg_frame'][key], dtype=np.float32))
+    return list(leads), np.stack(rows)
+
+#h5py is only required by the hdf5 output sink, so it is imported when the sink or its reader is created
+def import_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise Exception("The hdf5 output sink requires h5py, please install it or re-check the --output_sink argument!")
+    return h5py
+
+class HDF5ShardSink(ShardSink):
+    """Append samples to rolling chunked and compressed HDF5 files
+
+    Every file holds the samples of one stream. Values with one entry per sample are datasets
+    of length num_samples. Ragged values (images, the lead table and signals) are stored flat,
+    along with an (num_samples, 2) index of the first row and the number of rows of every
+    sample, so that any sample is read without loading the rest of the file. Datasets:
+
+        keys, sampling_frequency, resolution, x_grid, y_grid    one entry per sample
+        images/data, images/index, images/shape                 uint8 pixels of the (height, width, 3) images
+        leads/name, leads/start_sample, leads/end_sample,       one row per lead of every image, boxes are
+        leads/bounding_box, leads/text_bounding_box,            (4, 2) arrays of (y, x) pixel coordinates
+        leads/index
+        signals/data, signals/index, signals/shape,             segmented signal of write_wfdb_file, flattened
+        signals/leads                                           from (leads, samples), and its lead names
+        annotations/data, annotations/index                     JSON annotations, with --store_config
+
+    Completed files are listed in hdf5_index.jsonl and read with HDF5SampleReader.
+    """
+    extension = '.h5'
+    index_name = 'hdf5_index.jsonl'
+
+    def __init__(self, output_directory, stream, max_shard_size):
+        self.h5py = import_h5py()
+        super().__init__(output_directory, stream, max_shard_size)
+
+    def start_shard(self, shard_file):
+        shard_file.close()
+        self.h5 = self.h5py.File(os.path.join(self.output_directory, self.shard_name), 'w')
+
+        def create(name, shape, dtype, chunk_rows=1024):
+            self.h5.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape, dtype=dtype,
+                                   chunks=(chunk_rows,) + shape, compression='gzip', compression_opts=HDF5_COMPRESSION_LEVEL, shuffle=np.dtype(dtype).itemsize > 1)
+
+        string = self.h5py.string_dtype()
+        create('keys', (), string)
+        create('sampling_frequency', (), np.float64)
+        create('resolution', (), np.int32)
+        create('x_grid', (), np.float64)
+        create('y_grid', (), np.float64)
+        create('images/data', (), np.uint8, HDF5_CHUNK_SIZE)
+        create('images/index', (2,), np.int64)
+        create('images/shape', (3,), np.int32)
+        create('leads/name', (), string)
+        create('leads/start_sample', (), np.int64)
+        create('leads/end_sample', (), np.int64)
+        create('leads/bounding_box', (4, 2), np.float32)
+        create('leads/text_bounding_box', (4, 2), np.float32)
+        create('leads/index', (2,), np.int64)
+        create('signals/data', (), np.float32, HDF5_CHUNK_SIZE // 4)
+        create('signals/index', (2,), np.int64)
+        create('signals/shape', (2,), np.int32)
+        create('signals/leads', (), string)
+        create('annotations/data', (), np.uint8, HDF5_CHUNK_SIZE)
+        create('annotations/index', (2,), np.int64)
+
+    def finish_shard(self):
+        self.h5.close()
+
+    def shard_size(self):
+        return self.h5.id.get_filesize()
+
+    def append(self, name, rows):
+        dataset = self.h5[name]
+        start = dataset.shape[0]
+        dataset.resize(start + len(rows), axis=0)
+        if len(rows) > 0:
+            dataset[start:] = rows
+        return start
+
+    def append_ragged(self, name, rows):
+        start = self.append(name + '/data', rows)
+        self.append(name + '/index', np.array([[start, len(rows)]]))
+
+    def write_sample(self, image_file, image, image_options, json_file=None, json_dict=None, record=None, annotation_format='json'):
+        #Arrays are prepared outside of the lock, only the appends to the file are serialized
+        image = np.ascontiguousarray(image[:, :, :3])
+        leads = json_dict['leads']
+        lead_names = [lead['lead_name'] for lead in leads]
+        start_samples = np.array([lead['start_sample'] for lead in leads], dtype=np.int64)
+        end_samples = np.array([lead['end_sample'] for lead in leads], dtype=np.int64)
+        bounding_boxes = np.array([get_box_corners(lead, 'lead_bounding_box') for lead in leads], dtype=np.float32).reshape(-1, 4, 2)
+        text_bounding_boxes = np.array([get_box_corners(lead, 'text_bounding_box') for lead in leads], dtype=np.float32).reshape(-1, 4, 2)
+        signal_leads, signal = get_record_signal(record)
+        annotations = np.frombuffer(encode_json(json_dict), dtype=np.uint8) if json_file is not None else np.zeros(0, dtype=np.uint8)
+
+        def add():
+            self.append('keys', [self.sample_key(image_file)])
+            self.append('sampling_frequency', [json_dict['sampling_frequency']])
+            self.append('resolution', [json_dict['resolution']])
+            self.append('x_grid', [json_dict['x_grid']])
+            self.append('y_grid', [json_dict['y_grid']])
+            self.append_ragged('images', image.reshape(-1))
+            self.append('images/shape', [image.shape])
+            start = self.append('leads/name', lead_names)
+            self.append('leads/start_sample', start_samples)
+            self.append('leads/end_sample', end_samples)
+            self.append('leads/bounding_box', bounding_boxes)
+            self.append('leads/text_bounding_box', text_bounding_boxes)
+            self.append('leads/index', np.array([[start, len(leads)]]))
+            self.append_ragged('signals', signal.reshape(-1))
+            self.append('signals/shape', [signal.shape])
+            self.append('signals/leads', [','.join(signal_leads)])
+            self.append_ragged('annotations', annotations)
+        self.add_sample(self.sample_key(image_file), add)
+
+class HDF5SampleReader:
+    """Random access to the samples written by HDF5ShardSink, by global sample index
+
+    Samples are numbered in the order of the completed files in hdf5_index.jsonl. Reading a sample
+    only reads the chunks holding it.
+
+    Args:
+        output_directory (str): Output directory of the batch run
+    """
+    def __init__(self, output_directory):
+        self.h5py = import_h5py()
+        self.output_directory = output_directory
+        self.shards = []
+        self.offsets = [0]
+        with open(os.path.join(output_directory, HDF5ShardSink.index_name), 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.shards.append(entry['shard'])
+                self.offsets.append(self.offsets[-1] + entry['num_samples'])
+        self.files = dict()
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        shard = bisect.bisect_right(self.offsets, index) - 1
+        if shard not in self.files:
+            self.files[shard] = self.h5py.File(os.path.join(self.output_directory, self.shards[shard]), 'r')
+        h5 = self.files[shard]
+        k = index - self.offsets[shard]
+
+        def ragged(name):
+            start, count = h5[name + '/index'][k]
+            return h5[name + '/data'][start:start + count]
+
+        sample = dict()
+        sample['key'] = h5['keys'].asstr()[k]
+        for name in ('sampling_frequency', 'resolution', 'x_grid', 'y_grid'):
+            sample[name] = h5[name][k].item()
+        sample['image'] = ragged('images').reshape(h5['images/shape'][k])
+        start, count = h5['leads/index'][k]
+        sample['leads'] = {'name': list(h5['leads/name'].asstr()[start:start + count])}
+        for name in ('start_sample', 'end_sample', 'bounding_box', 'text_bounding_box'):
+            sample['leads'][name] = h5['leads/' + name][start:start + count]
+        sample['signal'] = ragged('signals').reshape(h5['signals/shape'][k])
+        sample['signal_leads'] = h5['signals/leads'].asstr()[k].split(',')
+        annotations = ragged('annotations')
+        sample['annotations'] = json.loads(annotations.tobytes()) if len(annotations) > 0 else None
+        return sample
+
+    def close(self):
+        for h5 in self.files.values():
+            h5.close()
+        self.files = dict()
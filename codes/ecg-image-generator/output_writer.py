@@ -0,0 +1,108 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+class OutputWriter:
+    """Write outputs on background threads while the next image is rendered
+
+    Writes are handed to a thread pool through a bounded queue: submit blocks once
+    max_pending writes are in flight, which bounds the memory held by images waiting
+    to be encoded. PIL, zlib and file writes release the GIL, so encoding and I/O
+    overlap with rendering. Errors of failed writes are raised by flush.
+
+    Args:
+        num_threads (int): Number of writer threads, 0 writes synchronously in the caller
+        max_pending (int): Maximum number of writes queued or in progress
+    """
+    def __init__(self, num_threads=0, max_pending=8):
+        self.executor = ThreadPoolExecutor(num_threads) if num_threads > 0 else None
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.condition = threading.Condition()
+        self.pending = set()
+        self.errors = []
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on a writer thread, the arguments must not be modified afterwards
+
+        Returns:
+            future (Future): Completes once the write is done
+        """
+        if self.executor is None:
+            future = Future()
+            future.set_result(fn(*args, **kwargs))
+            return future
+
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except:
+            self.slots.release()
+            raise
+        with self.condition:
+            self.pending.add(future)
+        future.add_done_callback(self.on_done)
+        return future
+
+    def on_done(self, future):
+        self.on_finished(future)
+        self.slots.release()
+
+    def on_finished(self, future):
+        with self.condition:
+            self.pending.discard(future)
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+            self.condition.notify_all()
+
+    def call_after_pending(self, fn):
+        """Call fn once every write submitted so far has completed, fn is skipped if one of them failed
+
+        Used to mark a record as done only after all of its outputs are on disk. The call counts
+        as a pending write itself, so flush also waits for it.
+        """
+        with self.condition:
+            futures = list(self.pending)
+        if not futures:
+            fn()
+            return
+
+        after = Future()
+        with self.condition:
+            self.pending.add(after)
+        after.add_done_callback(self.on_finished)
+
+        remaining = [len(futures)]
+        lock = threading.Lock()
+        def on_done(future):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            try:
+                if all(f.exception() is None for f in futures):
+                    fn()
+                after.set_result(None)
+            except Exception as e:
+                after.set_exception(e)
+        for future in futures:
+            future.add_done_callback(on_done)
+
+    def raise_errors(self):
+        """Raise the first error of the writes completed so far, without waiting for the pending ones"""
+        with self.condition:
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+
+    def flush(self):
+        """Wait for every submitted write and raise the first error, if any write failed"""
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
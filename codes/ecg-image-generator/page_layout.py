@@ -0,0 +1,147 @@
+from math import ceil
+import numpy as np
+from lru_cache import LRUCache
+
+standard_values = {'y_grid_size' : 0.5,
+                   'x_grid_size' : 0.2,
+                   'y_grid_inch' : 5/25.4,
+                   'x_grid_inch' : 5/25.4,
+                   'grid_line_width' : 0.5,
+                   'lead_name_offset' : 0.5,
+                   'lead_fontsize' : 11,
+                   'x_gap' : 1,
+                   'y_gap' : 0.5,
+                   'display_factor' : 1,
+                   'line_width': 0.75,
+                   'row_height' : 8,
+                   'dc_offset_length' : 0.2,
+                   'lead_length' : 3,
+                   'V1_length' : 12,
+                   'width' : 11,
+                   'height' : 8.5
+                   }
+
+papersize_values = {'A0' : (33.1,46.8),
+                    'A1' : (33.1,23.39),
+                    'A2' : (16.54,23.39),
+                    'A3' : (11.69,16.54),
+                    'A4' : (8.27,11.69),
+                    'letter' : (8.5,11)
+                    }
+
+#Number of columns and rhythm strip lead of a page of full_leads: 2 leads are plotted in one column without
+#a rhythm strip, 12 leads in 4 columns with the full_mode lead (or the first one) as rhythm strip, any other
+#number of leads in 4 columns without a rhythm strip. columns=-1 selects the default number of columns.
+def get_layout_format(full_leads, columns, full_mode):
+    if(len(full_leads)==2):
+        full_mode = 'None'
+        if(columns==-1):
+            columns = 1
+    elif(len(full_leads)==12):
+        if full_mode not in full_leads:
+            full_mode = full_leads[0]
+        if(columns==-1):
+            columns = 4
+    else:
+        columns = 4
+        full_mode = 'None'
+    return columns, full_mode
+
+class PageLayout:
+    """Geometry of an ECG page, shared by the segmentation of a record and the plotting of its pages
+
+    Positions are in the data coordinates of the page axes: seconds along x and mV along y,
+    with the rows of leads stacked from the bottom of the page and the rhythm strip below them.
+
+    Args:
+        lead_index (list): Names of the leads of the record
+        columns (int): Number of columns of leads
+        full_mode (str): Lead of the rhythm strip, 'None' for no rhythm strip
+        papersize (str): Key of papersize_values, '' for the standard 11 x 8.5 inch page
+        resolution (int): Resolution of the page in dots per inch
+        lead_length_in_seconds (float): Length of the segment of each lead
+        sample_rate (float): Sampling rate of the record
+        configs (dict): Generator config, for the lead order, the 4 x 3 format and the separator ticks
+    """
+    def __init__(self, lead_index, columns, full_mode, papersize, resolution, lead_length_in_seconds, sample_rate, configs):
+        self.columns = columns
+        self.full_mode = full_mode
+        self.resolution = resolution
+        self.rows = int(ceil(len(lead_index)/columns))
+        if(full_mode!='None'):
+            self.rows += 1
+
+        if papersize=='':
+            self.width = standard_values['width']
+            self.height = standard_values['height']
+        else:
+            self.width = papersize_values[papersize][1]
+            self.height = papersize_values[papersize][0]
+        self.width_pixels = int(self.width*resolution)
+        self.height_pixels = int(self.height*resolution)
+
+        #Each big grid square is 5 mm, i.e. 0.2 seconds and 0.5 mV
+        y_grid = standard_values['y_grid_inch']
+        x_grid = standard_values['x_grid_inch']
+        self.y_grid_dots = y_grid*resolution
+        self.x_grid_dots = x_grid*resolution
+        self.row_height = (self.height * standard_values['y_grid_size']/y_grid)/(self.rows+2)
+        self.x_min = 0
+        self.x_max = self.width * standard_values['x_grid_size'] / x_grid
+        self.y_min = 0
+        self.y_max = self.height * standard_values['y_grid_size']/y_grid
+        self.x_gap = np.floor(((self.x_max - (columns*lead_length_in_seconds))/2)/0.2)*0.2
+
+        #Calibration pulse of 0.2 seconds with 2 leading and trailing zeros, plotted before the first lead of each row
+        self.step = (1.0/sample_rate)
+        self.dc_offset_length = sample_rate*standard_values['dc_offset_length']*self.step
+        self.dc_x = np.arange(0,self.dc_offset_length + 4*self.step,self.step)
+        dc_pulse = np.ones(len(self.dc_x))
+        self.dc_pulse = np.concatenate(((0,0),dc_pulse[2:-2],(0,0)))
+
+        #Leads in plotting order with their offsets, each row is shifted up by row_height from the one below it
+        self.leads = []
+        y_offset = (self.row_height/2)
+        for i in range(len(lead_index)):
+            lead_name = configs['leadNames_12'][i] if len(lead_index) == 12 else lead_index[i]
+            if(i%columns==0):
+                y_offset += self.row_height
+            x_offset = (i%columns)*lead_length_in_seconds if columns > 1 else 0
+            self.leads.append((lead_name, x_offset, y_offset))
+
+        #Separator ticks between the columns of a row, centred on the row
+        self.tick_count = round(configs['tickLength']*self.y_grid_dots)
+        tick_half_height = configs['tickLength']/2*self.y_grid_dots*configs['tickSize_step']
+        self.tick_y = [np.linspace(y_offset - tick_half_height, y_offset + configs['tickSize_step']*self.y_grid_dots*configs['tickLength']/2, self.tick_count) for lead_name, x_offset, y_offset in self.leads]
+
+        #In the 4 x 3 format, the leads of column k start k lead lengths after the start of the page
+        self.sample_offsets = dict()
+        if columns == 4:
+            for k in (3, 2, 1):
+                for lead_name in configs['format_4_by_3'][k]:
+                    self.sample_offsets[lead_name] = int(k*sample_rate*lead_length_in_seconds)
+        self.time_axes = dict()
+
+    #Offset of the first sample of a lead from the start of the page
+    def get_sample_offset(self, lead_name):
+        return self.sample_offsets.get(lead_name, 0)
+
+    #Times of num_samples samples from the start of a lead, shared by every lead of that length
+    def get_time_axis(self, num_samples):
+        if num_samples not in self.time_axes:
+            time_axis = np.arange(0,num_samples*self.step,self.step)
+            time_axis.setflags(write=False)
+            self.time_axes[num_samples] = time_axis
+        return self.time_axes[num_samples]
+
+page_layouts = LRUCache(max_entries=64)
+
+def get_page_layout(lead_index, columns, full_mode, papersize, resolution, lead_length_in_seconds, sample_rate, configs):
+    """Layout of a page, computed once per distinct page and reused, least recently used first evicted
+
+    See PageLayout for the arguments. The config is part of the key through the values the layout uses.
+    """
+    key = (tuple(lead_index), columns, full_mode, papersize, resolution, lead_length_in_seconds, sample_rate,
+           tuple(configs['leadNames_12']), tuple(tuple(leads) for leads in configs['format_4_by_3']),
+           configs['tickLength'], configs['tickSize_step'])
+    return page_layouts.get(key, lambda: PageLayout(lead_index, columns, full_mode, papersize, resolution, lead_length_in_seconds, sample_rate, configs))
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import resource
+import threading
+import numpy as np
+from contextlib import contextmanager
+
+# Callbacks invoked as on_start(stage) and on_end(stage, wall_time, cpu_time, peak_rss)
+stage_hooks = []
+# Open stages and the record being generated, per thread: the outputs are encoded on writer threads
+# while the main thread renders the next image
+thread_state = threading.local()
+
+def get_stage_stack():
+    if not hasattr(thread_state, 'stack'):
+        thread_state.stack = []
+    return thread_state.stack
+
+def set_stage_record(record):
+    thread_state.record = record
+
+def get_stage_record():
+    return getattr(thread_state, 'record', None)
+
+#CPU time of a stage: of the whole process on the main thread, so that native helper threads are counted,
+#and of the thread itself elsewhere, so that writer threads do not count the rendering
+def read_cpu_time():
+    if threading.current_thread() is threading.main_thread():
+        return time.process_time()
+    return time.thread_time()
+
+def staged(name, fn):
+    """Wrap fn to run as stage name on any thread, attributed to the record being generated when it is wrapped"""
+    record = get_stage_record()
+    def run(*args, **kwargs):
+        previous = get_stage_record()
+        set_stage_record(record)
+        try:
+            with stage(name):
+                return fn(*args, **kwargs)
+        finally:
+            set_stage_record(previous)
+    return run
+
+def add_stage_hooks(on_start=None, on_end=None):
+    """Register callbacks invoked when a pipeline stage starts and ends
+
+    Args:
+        on_start (callable): Called as on_start(stage) before the stage runs
+        on_end (callable): Called as on_end(stage, wall_time, cpu_time, peak_rss) after the stage,
+            with times in seconds and the peak resident set size in MB
+
+    Returns:
+        hooks (tuple): Handle to pass to remove_stage_hooks
+    """
+    hooks = (on_start, on_end)
+    stage_hooks.append(hooks)
+    return hooks
+
+def remove_stage_hooks(hooks):
+    stage_hooks.remove(hooks)
+
+# Peak RSS in MB. On Linux the high-water mark is reset at the start of every stage so that
+# each stage reports its own peak, elsewhere the peak of the whole process is reported.
+def read_peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def start_stage(name):
+    if not stage_hooks:
+        return
+    for on_start, on_end in stage_hooks:
+        if on_start is not None:
+            on_start(name)
+    #Fold the peak reached so far into the enclosing stage before resetting the high-water mark. The mark is
+    #shared by the whole process, so only the main thread resets it
+    stage_stack = get_stage_stack()
+    if stage_stack:
+        stage_stack[-1]['peak_rss'] = max(stage_stack[-1]['peak_rss'], read_peak_rss())
+    if threading.current_thread() is threading.main_thread():
+        reset_peak_rss()
+    stage_stack.append({'name': name, 'wall': time.perf_counter(), 'cpu': read_cpu_time(), 'peak_rss': 0})
+
+def end_stage(name):
+    stage_stack = get_stage_stack()
+    if not stage_stack or stage_stack[-1]['name'] != name:
+        return
+    current = stage_stack.pop()
+    wall_time = time.perf_counter() - current['wall']
+    cpu_time = read_cpu_time() - current['cpu']
+    peak_rss = max(current['peak_rss'], read_peak_rss())
+    if stage_stack:
+        stage_stack[-1]['peak_rss'] = max(stage_stack[-1]['peak_rss'], peak_rss)
+    for on_start, on_end in stage_hooks:
+        if on_end is not None:
+            on_end(name, wall_time, cpu_time, peak_rss)
+
+@contextmanager
+def stage(name):
+    start_stage(name)
+    try:
+        yield
+    finally:
+        end_stage(name)
+
+class StageRecorder:
+    """Record the wall time, CPU time and peak RSS of every stage as JSONL
+
+    Nested stages are reported inclusively, e.g. 'ecg_plot' includes 'savefig'. Every entry is
+    attributed to the record set with set_stage_record on the thread running the stage.
+
+    Args:
+        timings_file (str): Complete path to the JSONL file, appended to by every process
+    """
+    def __init__(self, timings_file):
+        self.timings_file = timings_file
+        self.hooks = add_stage_hooks(on_end=self.on_end)
+
+    def on_end(self, name, wall_time, cpu_time, peak_rss):
+        entry = {'record': get_stage_record(), 'stage': name, 'wall_time': round(wall_time, 6), 'cpu_time': round(cpu_time, 6), 'peak_rss_mb': round(peak_rss, 2)}
+        line = (json.dumps(entry) + '\n').encode('utf-8')
+        fd = os.open(self.timings_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        remove_stage_hooks(self.hooks)
+
+def summarize_stage_timings(timings_file):
+    """Compute p50/p95/max of every measure per stage from a JSONL timings file
+
+    Returns:
+        summary (dict): For every stage, the number of samples and the p50, p95 and max of each measure
+    """
+    values = dict()
+    with open(timings_file, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            stage_values = values.setdefault(entry['stage'], {'wall_time': [], 'cpu_time': [], 'peak_rss_mb': []})
+            for key in stage_values:
+                stage_values[key].append(entry[key])
+
+    summary = dict()
+    for name in values:
+        summary[name] = {'count': len(values[name]['wall_time'])}
+        for key in values[name]:
+            v = np.array(values[name][key])
+            summary[name][key] = {'p50': float(np.percentile(v, 50)), 'p95': float(np.percentile(v, 95)), 'max': float(np.max(v))}
+    return summary
+
+def print_stage_summary(summary):
+    print('{:<14}{:>7}{:>26}{:>26}{:>26}'.format('stage', 'count', 'wall p50/p95/max (s)', 'cpu p50/p95/max (s)', 'rss p50/p95/max (MB)'))
+    for name in summary:
+        row = summary[name]
+        cols = ['{:.3f}/{:.3f}/{:.3f}'.format(row[key]['p50'], row[key]['p95'], row[key]['max']) for key in ('wall_time', 'cpu_time')]
+        cols.append('{:.0f}/{:.0f}/{:.0f}'.format(row['peak_rss_mb']['p50'], row['peak_rss_mb']['p95'], row['peak_rss_mb']['max']))
+        print('{:<14}{:>7}{:>26}{:>26}{:>26}'.format(name, row['count'], *cols))
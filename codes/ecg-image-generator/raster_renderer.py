@@ -0,0 +1,253 @@
+import numpy as np
+import cv2
+from font_cache import font_cache
+from matplotlib.font_manager import findfont, FontProperties
+from matplotlib.colors import to_rgb
+
+#Matplotlib defaults reproduced by the raster renderer, sizes in points
+default_font_size = 10
+title_font_size = 12
+spine_line_width = 0.8
+
+#Traces are drawn on a canvas supersampled by this factor and area-averaged, which anti-aliases them
+#with the fractional line widths of matplotlib (cv2.LINE_AA only draws a few coarse widths)
+supersampling = 4
+
+#Font of the lead names and printed text, the default matplotlib font at fontsize points, see FontCache.get_font
+def get_text_font(fontsize, dpi):
+    return font_cache.get_font(findfont(FontProperties()), fontsize, dpi)
+
+#Colour given as floats in [0, 1] or as a name understood by matplotlib, as 8-bit RGB
+def to_rgb255(color):
+    return tuple(int(round(c*255)) for c in to_rgb(color))
+
+#Pixels covered by the interval [start, end) and the fraction of each one that is covered
+def get_coverage(start, end, size):
+    first, last = int(np.floor(start)), int(np.ceil(end))
+    pixels = np.arange(max(first, 0), min(last, size))
+    coverage = np.minimum(pixels + 1, end) - np.maximum(pixels, start)
+    return pixels, coverage
+
+class Extent:
+    """Bounding box in display pixels, y from the bottom, with the attributes of a matplotlib Bbox"""
+    def __init__(self, x0, y0, x1, y1):
+        self.x0, self.y0, self.x1, self.y1 = x0, y0, x1, y1
+
+class RasterArtist:
+    def __init__(self, extent):
+        self.extent = extent
+
+    def get_window_extent(self, renderer=None):
+        return self.extent
+
+class RasterText(RasterArtist):
+    """Text of a RasterAxes, with the accessors of a matplotlib Text used to look up its metrics"""
+    def __init__(self, axes, x, y, s, fontsize):
+        self.axes = axes
+        self.position = (x, y)
+        self.s = s
+        self.fontsize = fontsize
+
+    def get_text(self):
+        return self.s
+
+    def get_fontsize(self):
+        return self.fontsize
+
+    def get_position(self):
+        return self.position
+
+    def get_fontproperties(self):
+        return FontProperties(fname=findfont(FontProperties()), size=self.fontsize)
+
+    def get_window_extent(self, renderer=None):
+        x, y = self.axes.transData.transform([self.position])[0]
+        font, ascent, descent = get_text_font(self.fontsize, self.axes.figure.dpi)
+        left, top, right, bottom = font.getbbox(self.s, anchor='ls')
+        return Extent(x, y - max(descent, bottom), x + right, y + max(ascent, -top))
+
+class RasterTransform:
+    """Affine transform from data coordinates to display pixels, scale*point + offset"""
+    def __init__(self, scale, offset):
+        self.scale = np.asarray(scale, dtype=float)
+        self.offset = np.asarray(offset, dtype=float)
+
+    def transform(self, points):
+        return np.asarray(points, dtype=float)*self.scale + self.offset
+
+    def inverted(self):
+        return RasterTransform(1/self.scale, -self.offset/self.scale)
+
+class RasterCanvas:
+    renderer = None
+
+    def get_renderer(self):
+        return self.renderer
+
+class RasterFigure:
+    """Page drawn directly into a NumPy array with OpenCV and PIL instead of matplotlib
+
+    RasterFigure and RasterAxes provide the subset of the matplotlib Figure and Axes API used
+    by ecg_plot (plot, text, transData and get_window_extent of the returned artists), so the
+    layout of ecg_plot is shared by both renderers. Drawing is deferred to render, which
+    paints the grid, traces, frame and text in the order matplotlib does.
+
+    Args:
+        width, height (float): Page size in inches
+        dpi (int): Resolution in dots per inch
+    """
+    def __init__(self, width, height, dpi):
+        self.dpi = dpi
+        self.width = int(width*dpi)
+        self.height = int(height*dpi)
+        self.display_width = width*dpi
+        self.display_height = height*dpi
+        self.canvas = RasterCanvas()
+        self.title = ''
+        self.axes = None
+
+    def suptitle(self, title):
+        self.title = title
+
+    def render(self):
+        """Draw the page, returns the opaque RGBA image as an array"""
+        ax = self.axes
+        image = self.draw_grid(ax.grid_lines if ax.grid_lines is not None else [])
+        for points, colour, width in ax.lines:
+            self.draw_line(image, points, colour, width)
+        self.draw_frame(image)
+        for x, y, text, fontsize in ax.texts:
+            self.draw_text(image, x, self.display_height - y, text, fontsize, 'ls')
+        if self.title:
+            self.draw_text(image, self.display_width/2, 0.02*self.display_height, self.title, title_font_size, 'mt')
+        return image
+
+    #Black text anchored at a position in pixels from the top left, blended through the glyph mask of the string
+    def draw_text(self, image, column, row, text, fontsize, anchor):
+        #The sprite keeps the fractional part of the position, so glyphs are rendered as on the whole page
+        mask, x0, y0 = font_cache.get_sprite(findfont(FontProperties()), fontsize, self.dpi, text, anchor, column, row)
+        x1, y1 = x0 + mask.shape[1], y0 + mask.shape[0]
+
+        cx0, cy0 = max(x0, 0), max(y0, 0)
+        cx1, cy1 = min(x1, self.width), min(y1, self.height)
+        if cx1 <= cx0 or cy1 <= cy0:
+            return
+        alpha = mask[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0, None].astype(np.float32)/255
+        region = image[cy0:cy1, cx0:cx1, :3]
+        region[...] = np.round(region*(1 - alpha))
+
+    #Polyline blended with its coverage of every pixel, rasterised on a supersampled crop around the line
+    def draw_line(self, image, points, colour, width):
+        s = supersampling
+        pixels = np.column_stack((points[:, 0], self.display_height - points[:, 1]))
+        x0, y0 = np.maximum(np.floor(pixels.min(axis=0) - width), 0).astype(int)
+        x1, y1 = np.minimum(np.ceil(pixels.max(axis=0) + width), (self.width, self.height)).astype(int)
+        if x1 <= x0 or y1 <= y0:
+            return
+
+        mask = np.zeros(((y1 - y0)*s, (x1 - x0)*s), dtype=np.uint8)
+        #Points are scaled to the supersampled pixel centres, with 4 fractional bits for sub-pixel precision
+        scaled = (pixels - (x0, y0))*s - 0.5
+        cv2.polylines(mask, [np.round(scaled*16).astype(np.int32)], False, 255, max(1, int(round(width*s))), cv2.LINE_8, shift=4)
+        coverage = cv2.resize(mask, (x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA)
+
+        region = image[y0:y1, x0:x1]
+        covered = coverage > 0
+        alpha = coverage[covered][:, None].astype(np.float32)/255
+        pixels = region[covered]
+        pixels[:, :3] = np.round(pixels[:, :3]*(1 - alpha) + np.array(colour, dtype=np.float32)*alpha)
+        region[covered] = pixels
+
+    #Pixels covered by an axis-aligned line at a display position, snapped like the Agg grid lines: to the nearest
+    #pixel centre when the rounded width of the line is odd, and to the nearest pixel edge when it is even
+    def get_straight_line_coverage(self, vertical, position, width):
+        snap = 0.5 if int(np.floor(width + 0.5)) % 2 else 0.0
+        if vertical:
+            centre = np.floor(position + 0.5) + snap
+            return get_coverage(centre - width/2, centre + width/2, self.width)
+        centre = np.floor(self.display_height - position + 0.5) + snap
+        return get_coverage(centre - width/2, centre + width/2, self.height)
+
+    #Opaque white RGBA page with the grid. Vertical lines are drawn first, so every row starts as the same row,
+    #then the horizontal lines replace whole rows, all at once unless two of them share a row
+    def draw_grid(self, grid_lines):
+        row = np.full((self.width, 4), 255, dtype=np.float32)
+        rows, coverages, colours = [], [], []
+        for vertical, position, colour, width in grid_lines:
+            pixels, coverage = self.get_straight_line_coverage(vertical, position, width)
+            if vertical:
+                row[pixels, :3] = np.round(row[pixels, :3]*(1 - coverage[:, None]) + np.array(colour)*coverage[:, None])
+            else:
+                rows.append(pixels)
+                coverages.append(coverage)
+                colours.append(np.repeat([colour], len(pixels), axis=0))
+
+        image = np.repeat(row.astype(np.uint8)[None], self.height, axis=0)
+        if rows:
+            rows = np.concatenate(rows)
+            coverage = np.concatenate(coverages)[:, None, None]
+            colours = np.concatenate(colours)[:, None, :]
+            if len(np.unique(rows)) == len(rows):
+                #Lines only differ by a few coverage and colour pairs, each blended row is computed once
+                pairs, inverse = np.unique(np.concatenate((coverage[:, :, 0], colours[:, 0]), axis=1), axis=0, return_inverse=True)
+                blended = np.repeat(row[None], len(pairs), axis=0)
+                blended[:, :, :3] = np.round(row[None, :, :3]*(1 - pairs[:, :1, None]) + pairs[:, None, 1:]*pairs[:, :1, None])
+                image[rows] = blended.astype(np.uint8)[inverse.reshape(-1)]
+            else:
+                for r, a, c in zip(rows, coverage, colours):
+                    image[r, :, :3] = np.round(image[r, :, :3]*(1 - a) + c*a)
+        return image
+
+    #Black frame of the axes, centred on the page border
+    def draw_frame(self, image):
+        width = spine_line_width*self.dpi/72
+        for vertical, position in ((True, 0), (True, self.display_width), (False, 0), (False, self.display_height)):
+            size = self.width if vertical else self.height
+            pixels, coverage = get_coverage(position - width/2, position + width/2, size)
+            if vertical:
+                image[:, pixels, :3] = np.round(image[:, pixels, :3]*(1 - coverage[None, :, None]))
+            else:
+                image[pixels, :, :3] = np.round(image[pixels, :, :3]*(1 - coverage[:, None, None]))
+
+class RasterAxes:
+    """Axes spanning a whole RasterFigure, see RasterFigure"""
+    def __init__(self, figure, x_min, x_max, y_min, y_max):
+        self.figure = figure
+        figure.axes = self
+        self.x_min, self.x_max, self.y_min, self.y_max = x_min, x_max, y_min, y_max
+        scale = (figure.display_width/(x_max - x_min), figure.display_height/(y_max - y_min))
+        self.transData = RasterTransform(scale, (-x_min*scale[0], -y_min*scale[1]))
+        self.lines = []
+        self.texts = []
+        self.grid_lines = None
+
+    def plot(self, x, y, linewidth=1.5, color=(0, 0, 0)):
+        points = self.transData.transform(np.column_stack((x, y)))
+        self.lines.append((points, to_rgb255(color), linewidth*self.figure.dpi/72))
+        extent = Extent(points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+        return [RasterArtist(extent)]
+
+    def text(self, x, y, s, fontsize=default_font_size):
+        self.texts.append((*self.transData.transform([[x, y]])[0], s, fontsize))
+        return RasterText(self, x, y, s, fontsize)
+
+    def draw_grid(self, x_grid_size, y_grid_size, minor_divisions, color_major, color_minor, linewidth):
+        """Major and minor grid lines as matplotlib draws them, x lines first and minor lines over major ones"""
+        width = linewidth*self.figure.dpi/72
+        major, minor = to_rgb255(color_major), to_rgb255(color_minor)
+        self.grid_lines = []
+        for vertical, low, high, step in ((True, self.x_min, self.x_max, x_grid_size), (False, self.y_min, self.y_max, y_grid_size)):
+            axis = 0 if vertical else 1
+            minor_step = step/minor_divisions
+            ticks = np.arange(int(np.ceil(low/minor_step - 1e-9)), int(np.floor(high/minor_step + 1e-9)) + 1)
+            major_ticks = ticks[ticks % minor_divisions == 0]
+            minor_ticks = ticks[ticks % minor_divisions != 0]
+            for tick_indices, colour in ((major_ticks, major), (minor_ticks, minor)):
+                positions = self.transData.transform(np.column_stack((tick_indices*minor_step, tick_indices*minor_step)))[:, axis]
+                self.grid_lines += [(vertical, position, colour, width) for position in positions]
+
+#Create a raster page with axes spanning the whole page, see RasterFigure
+def create_raster_page(width, height, resolution, x_min, x_max, y_min, y_max):
+    fig = RasterFigure(width, height, resolution)
+    ax = RasterAxes(fig, x_min, x_max, y_min, y_max)
+    return fig, ax
@@ -0,0 +1,33 @@
+import os, sys
+import numpy as np
+import pytest
+import wfdb
+
+GENERATOR_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GENERATOR_DIRECTORY)
+
+LEAD_NAMES = ['I', 'II', 'III', 'AVR', 'AVL', 'AVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6']
+
+#The generator loads its config, fonts and textures relative to its own directory
+@pytest.fixture(autouse=True)
+def generator_directory(monkeypatch):
+    monkeypatch.chdir(GENERATOR_DIRECTORY)
+    return GENERATOR_DIRECTORY
+
+@pytest.fixture
+def make_record():
+    return write_record
+
+def write_record(directory, name, rate=100, seconds=10, seed=0):
+    """Write a synthetic 12 lead WFDB record of sinusoids and noise in mV
+
+    Returns:
+        signal (ndarray): Samples of shape (rate*seconds, 12)
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(rate*seconds))/rate
+    signal = np.stack([np.sin(2*np.pi*(1 + 0.1*k)*t)*(0.5 + 0.1*k) for k in range(len(LEAD_NAMES))], axis=1)
+    signal += 0.05*rng.standard_normal(signal.shape)
+    wfdb.wrsamp(name, fs=rate, units=['mV']*len(LEAD_NAMES), sig_name=LEAD_NAMES, p_signal=signal, fmt=['16']*len(LEAD_NAMES), adc_gain=[1000]*len(LEAD_NAMES), baseline=[0]*len(LEAD_NAMES), write_dir=directory)
+    return signal
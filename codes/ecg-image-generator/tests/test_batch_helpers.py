@@ -0,0 +1,167 @@
+import os
+import json
+import threading
+import multiprocessing
+import pytest
+import output_sinks
+from helper_functions import get_record_seed, get_shard, append_manifest_entry, read_manifest
+from gen_ecg_images_from_data_batch import get_parser, run, iter_jobs
+
+def run_batch(input_directory, output_directory, *options):
+    args = get_parser().parse_args(['-i', str(input_directory), '-o', str(output_directory), '-se', '7', '-r', '50'] + list(options))
+    return run(args)
+
+def read_outputs(output_directory):
+    outputs = dict()
+    for root, directories, files in os.walk(output_directory):
+        for file in files:
+            if file.endswith('.png') or file.endswith('.dat'):
+                with open(os.path.join(root, file), 'rb') as f:
+                    outputs[os.path.relpath(os.path.join(root, file), output_directory)] = f.read()
+    return outputs
+
+def test_record_seed_depends_only_on_seed_and_record():
+    seed = get_record_seed(10, 'a/r1.dat')
+    assert seed == get_record_seed(10, 'a/r1.dat')
+    assert 0 <= seed < 2**32
+    assert seed != get_record_seed(11, 'a/r1.dat')
+    assert seed != get_record_seed(10, 'a/r2.dat')
+
+def test_images_do_not_depend_on_number_of_workers(tmp_path, make_record):
+    for k, name in enumerate(['r1', 'r2', 'r3']):
+        make_record(tmp_path / 'input' / 'a', name, seed=k)
+
+    assert run_batch(tmp_path / 'input', tmp_path / 'serial') == 3
+    assert run_batch(tmp_path / 'input', tmp_path / 'parallel', '--num_workers', '2') == 3
+
+    serial, parallel = read_outputs(tmp_path / 'serial'), read_outputs(tmp_path / 'parallel')
+    assert len(serial) == 6
+    assert serial == parallel
+
+@pytest.mark.parametrize('num_shards', [1, 2, 3, 5])
+def test_shards_cover_every_record_once(num_shards):
+    records = [('r{}.hea'.format(k), 'r{}.dat'.format(k)) for k in range(17)]
+    record_sizes = [(k*7919) % 101 for k in range(len(records))]
+
+    shards = [get_shard(records, record_sizes, shard_index, num_shards) for shard_index in range(num_shards)]
+    assigned = [record for shard in shards for record in shard]
+    assert sorted(assigned) == sorted(records)
+    assert len(set(assigned)) == len(records)
+    #Every node computes the same split, and keeps the records in their original order
+    assert shards == [get_shard(list(records), list(record_sizes), shard_index, num_shards) for shard_index in range(num_shards)]
+    for shard in shards:
+        assert shard == sorted(shard, key=records.index)
+
+def test_shards_are_balanced_by_size():
+    records = [('r{}.hea'.format(k), 'r{}.dat'.format(k)) for k in range(8)]
+    record_sizes = [8, 7, 6, 5, 4, 3, 2, 1]
+    totals = [sum(record_sizes[records.index(record)] for record in get_shard(records, record_sizes, shard_index, 2)) for shard_index in range(2)]
+    assert totals == [18, 18]
+
+@pytest.mark.parametrize('shard_index, num_shards', [(-1, 2), (2, 2), (0, 0)])
+def test_invalid_shard_index_raises(shard_index, num_shards):
+    with pytest.raises(Exception):
+        get_shard([('r.hea', 'r.dat')], [1], shard_index, num_shards)
+
+def test_manifest_keeps_last_entry_of_each_record(tmp_path):
+    manifest_file = str(tmp_path / 'manifest.jsonl')
+    assert read_manifest(manifest_file) == {}
+
+    append_manifest_entry(manifest_file, {'record': 'r1.dat', 'status': 'started'})
+    append_manifest_entry(manifest_file, {'record': 'r2.dat', 'status': 'started'})
+    append_manifest_entry(manifest_file, {'record': 'r1.dat', 'status': 'done', 'num_images': 1})
+
+    manifest = read_manifest(manifest_file)
+    assert manifest['r1.dat'] == {'record': 'r1.dat', 'status': 'done', 'num_images': 1}
+    assert manifest['r2.dat']['status'] == 'started'
+
+def test_manifest_skips_truncated_last_line(tmp_path):
+    manifest_file = str(tmp_path / 'manifest.jsonl')
+    append_manifest_entry(manifest_file, {'record': 'r1.dat', 'status': 'done', 'num_images': 1})
+    with open(manifest_file, 'a') as f:
+        f.write('{"record": "r2.dat", "sta')
+
+    assert list(read_manifest(manifest_file).keys()) == ['r1.dat']
+
+def test_resume_after_truncated_manifest(tmp_path, make_record):
+    for k, name in enumerate(['r1', 'r2', 'r3']):
+        make_record(tmp_path / 'input' / 'a', name, seed=k)
+    reference = tmp_path / 'reference'
+    assert run_batch(tmp_path / 'input', reference) == 3
+
+    #An interrupted run that completed r1 and was writing the entry of r2
+    output = tmp_path / 'output'
+    assert run_batch(tmp_path / 'input', output, '--max_num_images', '1') == 1
+    manifest_file = str(output / 'manifest.jsonl')
+    done = [record for record, entry in read_manifest(manifest_file).items() if entry['status'] == 'done']
+    assert len(done) == 1
+    with open(manifest_file, 'a') as f:
+        f.write('{"record": "a/r2.dat", "sta')
+
+    assert run_batch(tmp_path / 'input', output, '--resume') == 3
+    manifest = read_manifest(manifest_file)
+    assert sorted(manifest.keys()) == ['a/r1.dat', 'a/r2.dat', 'a/r3.dat']
+    assert all(entry['status'] == 'done' for entry in manifest.values())
+    #The completed record is not generated again, and new entries start on their own line
+    with open(manifest_file, 'r') as f:
+        lines = f.read().splitlines()
+    assert sum(json.loads(line)['record'] == done[0] for line in lines if not line.endswith('"sta')) == 2
+    assert read_outputs(output) == read_outputs(reference)
+
+def test_max_num_images_holds_with_workers(tmp_path, make_record):
+    for k in range(6):
+        make_record(tmp_path / 'input' / 'a', 'r{}'.format(k), seed=k)
+
+    assert run_batch(tmp_path / 'input', tmp_path / 'output', '--max_num_images', '2', '--num_workers', '3') == 2
+    manifest = read_manifest(str(tmp_path / 'output' / 'manifest.jsonl'))
+    assert len(manifest) == 2
+    assert len([output for output in read_outputs(tmp_path / 'output') if output.endswith('.png')]) == 2
+
+def test_jobs_stop_once_the_limit_is_reserved():
+    args = get_parser().parse_args(['-i', 'input', '-o', 'output', '--max_num_images', '3'])
+    read = []
+    def records():
+        for k in range(1000):
+            read.append(k)
+            yield ('r{}.hea'.format(k), 'r{}.dat'.format(k), None)
+    counter = multiprocessing.Value('i', 0)
+    slots = threading.Semaphore(1000)
+
+    jobs = []
+    for job in iter_jobs(records(), args, 'output', 'manifest.jsonl', counter, slots, threading.Event()):
+        jobs.append(job)
+        counter.value += 1
+    assert [job[3] for job in jobs] == ['r0.dat', 'r1.dat', 'r2.dat']
+    assert len(read) == 4
+
+def test_resume_shard_with_workers(tmp_path, make_record):
+    for k in range(4):
+        make_record(tmp_path / 'input' / 'a', 'r{}'.format(k), seed=k)
+    reference = tmp_path / 'reference'
+    num_images = run_batch(tmp_path / 'input', reference, '--num_shards', '2', '--shard_index', '0')
+    assert num_images > 0
+
+    output = tmp_path / 'output'
+    assert run_batch(tmp_path / 'input', output, '--num_shards', '2', '--shard_index', '0', '--max_num_images', '1') == 1
+    assert run_batch(tmp_path / 'input', output, '--num_shards', '2', '--shard_index', '0', '--resume', '--num_workers', '2') == num_images
+
+    manifest = read_manifest(str(output / 'manifest-0-of-2.jsonl'))
+    assert len(manifest) == num_images
+    assert all(entry['status'] == 'done' for entry in manifest.values())
+    assert read_outputs(output) == read_outputs(reference)
+
+@pytest.mark.parametrize('num_workers', ['1', '3'])
+def test_write_errors_are_raised(tmp_path, make_record, monkeypatch, num_workers):
+    for k in range(3):
+        make_record(tmp_path / 'input' / 'a', 'r{}'.format(k), seed=k)
+    write_sample = output_sinks.FileSink.write_sample
+    def failing_write_sample(self, out, *args, **kwargs):
+        if os.path.basename(out) == 'r1-0.png':
+            raise OSError('No space left on device')
+        return write_sample(self, out, *args, **kwargs)
+    monkeypatch.setattr(output_sinks.FileSink, 'write_sample', failing_write_sample)
+
+    with pytest.raises(OSError):
+        run_batch(tmp_path / 'input', tmp_path / 'output', '--num_workers', num_workers)
+    manifest = read_manifest(str(tmp_path / 'output' / 'manifest.jsonl'))
+    assert manifest['a/r1.dat']['status'] == 'started'
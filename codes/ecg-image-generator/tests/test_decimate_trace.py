@@ -0,0 +1,57 @@
+import os
+import json
+import numpy as np
+from ecg_plot import create_page_figure, decimate_trace
+from gen_ecg_images_from_data_batch import get_parser, run
+
+def get_columns(ax, x_vals):
+    return np.floor(ax.transData.transform(np.column_stack((x_vals, np.zeros(len(x_vals)))))[:, 0])
+
+def test_decimated_trace_keeps_the_extremes_of_every_pixel_column():
+    #A 1 kHz lead of 2.5 seconds on an 11 x 8.5 inch page at 100 DPI, about 10 samples per pixel column
+    fig, ax = create_page_figure(11, 8.5, 100, 0, 11*0.2/(5/25.4), 0, 8.5*0.5/(5/25.4))
+    rng = np.random.default_rng(0)
+    x_vals = np.arange(0, 2.5, 0.001) + 1.2
+    y_vals = np.cumsum(rng.standard_normal(len(x_vals)))*0.05 + 10
+    y_vals[700:950] = np.nan
+
+    decimated_x, decimated_y = decimate_trace(ax, x_vals, y_vals)
+    assert len(decimated_x) < len(x_vals)/4
+    kept = np.flatnonzero(np.isin(x_vals, decimated_x))
+    assert len(kept) == len(decimated_x)
+    np.testing.assert_array_equal(decimated_y, y_vals[kept])
+
+    #The trace starts, ends and has its gap where it did
+    assert kept[0] == 0 and kept[-1] == len(x_vals) - 1
+    assert {700, 949} <= set(kept)
+
+    columns, decimated_columns = get_columns(ax, x_vals), get_columns(ax, decimated_x)
+    for column in np.unique(columns):
+        y = y_vals[columns == column]
+        decimated = decimated_y[decimated_columns == column]
+        if np.all(np.isnan(y)):
+            continue
+        assert np.nanmin(decimated) == np.nanmin(y)
+        assert np.nanmax(decimated) == np.nanmax(y)
+        assert np.count_nonzero(~np.isnan(decimated)) <= 4
+
+def test_decimated_trace_is_unchanged_below_two_samples_per_column():
+    fig, ax = create_page_figure(11, 8.5, 100, 0, 11*0.2/(5/25.4), 0, 8.5*0.5/(5/25.4))
+    x_vals = np.arange(0, 2.5, 0.01)
+    y_vals = np.sin(x_vals)
+    decimated_x, decimated_y = decimate_trace(ax, x_vals, y_vals)
+    assert decimated_x is x_vals and decimated_y is y_vals
+
+def test_decimated_pages_have_the_same_annotations(tmp_path, make_record):
+    make_record(tmp_path / 'input', 'r1', rate=1000)
+    def generate(output_directory, *options):
+        args = get_parser().parse_args(['-i', str(tmp_path / 'input'), '-o', str(output_directory), '-se', '2', '-r', '100',
+                                        '--store_config', '2', '--lead_bbox', '--lead_name_bbox'] + list(options))
+        assert run(args) == 1
+        with open(os.path.join(output_directory, 'r1-0.json'), 'r') as f:
+            return json.load(f)
+
+    annotations = generate(tmp_path / 'full')
+    decimated_annotations = generate(tmp_path / 'decimated', '--decimate_traces')
+    assert len(annotations['leads']) == 13
+    assert decimated_annotations == annotations
@@ -0,0 +1,57 @@
+import os
+from helper_functions import set_random_seed
+from gen_ecg_image_from_data import get_parser as get_single_parser, run_single_file
+from gen_ecg_images_from_data_batch import get_parser as get_batch_parser, run
+from job_plan import plan_record, write_plan_entry, read_plan
+from worker_context import WorkerContext
+
+OPTIONS = ['-se', '3', '-r', '60', '--random_resolution', '--random_padding', '--pad_inches', '1', '--random_bw', '0.5',
+           '--random_grid_present', '0.7', '--calibration_pulse', '0.5', '--wrinkles', '--augment', '--store_config', '2', '--lead_bbox', '--lead_name_bbox']
+
+def read_outputs(output_directory):
+    outputs = dict()
+    for root, directories, files in os.walk(output_directory):
+        for file in files:
+            if os.path.splitext(file)[1] in ('.png', '.json', '.hea', '.dat'):
+                with open(os.path.join(root, file), 'rb') as f:
+                    outputs[os.path.relpath(os.path.join(root, file), output_directory)] = f.read()
+    return outputs
+
+def test_replayed_plan_generates_the_same_record(tmp_path, make_record):
+    make_record(tmp_path, 'r1', seconds=20)
+    def get_args(output_directory):
+        os.makedirs(output_directory)
+        return get_single_parser().parse_args(['-i', str(tmp_path / 'r1.dat'), '-hea', str(tmp_path / 'r1.hea'), '-o', str(output_directory), '-st', '-1'] + OPTIONS)
+    context = WorkerContext('config.yaml')
+
+    set_random_seed(3)
+    plan = plan_record(get_args(tmp_path / 'planned'), context)
+    with open(tmp_path / 'plan.jsonl', 'w') as f:
+        write_plan_entry(f, plan)
+
+    set_random_seed(3)
+    assert run_single_file(get_args(tmp_path / 'direct'), context=context) == 2
+
+    #Every random choice is read from the plan, whatever the state of the random generators
+    set_random_seed(4)
+    replayed_plan, = read_plan(tmp_path / 'plan.jsonl')
+    assert run_single_file(get_args(tmp_path / 'replayed'), context=context, plan=replayed_plan) == 2
+
+    direct = read_outputs(tmp_path / 'direct')
+    assert len(direct) == 6
+    assert read_outputs(tmp_path / 'replayed') == direct
+
+def test_batch_plan_file_generates_the_same_images(tmp_path, make_record):
+    for k, name in enumerate(['r1', 'r2']):
+        make_record(tmp_path / 'input' / 'a', name, seed=k)
+    def run_batch(output_directory, *options):
+        return run(get_batch_parser().parse_args(['-i', str(tmp_path / 'input'), '-o', str(output_directory)] + OPTIONS + list(options)))
+
+    assert run_batch(tmp_path / 'direct') == 2
+    assert run_batch(tmp_path / 'planned', '--write_plan', str(tmp_path / 'plan.jsonl')) == 2
+    assert sorted(entry['record'] for entry in read_plan(tmp_path / 'plan.jsonl')) == ['a/r1.dat', 'a/r2.dat']
+    assert run_batch(tmp_path / 'replayed', '--plan_file', str(tmp_path / 'plan.jsonl'), '--num_workers', '2') == 2
+
+    direct = read_outputs(tmp_path / 'direct')
+    assert len(direct) == 8
+    assert read_outputs(tmp_path / 'replayed') == direct
@@ -0,0 +1,43 @@
+import numpy as np
+from lru_cache import LRUCache
+
+def test_least_recently_used_value_is_evicted():
+    cache = LRUCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.lookup('a') == 1
+    cache.put('c', 3)
+    assert cache.lookup('b') is None
+    assert cache.lookup('a') == 1 and cache.lookup('c') == 3
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+
+def test_get_creates_missing_values_once():
+    cache = LRUCache(max_entries=4)
+    created = []
+    def create():
+        created.append(1)
+        return len(created)
+    assert cache.get('a', create) == 1
+    assert cache.get('a', create) == 1
+    assert len(created) == 1
+
+def test_values_are_evicted_over_the_size_budget():
+    cache = LRUCache(max_size=100, size=lambda value: value.nbytes)
+    cache.put('a', np.zeros(40, dtype=np.uint8))
+    cache.put('b', np.zeros(40, dtype=np.uint8))
+    cache.lookup('a')
+    cache.put('c', np.zeros(40, dtype=np.uint8))
+    assert cache.lookup('b') is None
+    assert cache.total_size == 80
+
+    #A value larger than the whole budget is returned without evicting the others
+    large = cache.put('d', np.zeros(200, dtype=np.uint8))
+    assert len(large) == 200 and cache.lookup('d') is None
+    assert len(cache) == 2
+
+def test_replaced_value_is_counted_once():
+    cache = LRUCache(max_size=100, size=lambda value: value.nbytes)
+    cache.put('a', np.zeros(40, dtype=np.uint8))
+    cache.put('a', np.zeros(60, dtype=np.uint8))
+    assert cache.total_size == 60 and len(cache) == 1
@@ -0,0 +1,20 @@
+import pytest
+import profiling
+from profiling import add_stage_hooks, remove_stage_hooks
+from extract_leads import get_paper_ecg
+from helper_functions import read_config_file
+
+def test_stages_are_closed_when_a_record_fails(tmp_path, make_record):
+    make_record(tmp_path, 'r1')
+    with open(tmp_path / 'r1.dat', 'wb') as f:
+        f.truncate(0)
+    ended = []
+    hooks = add_stage_hooks(on_end=lambda name, wall_time, cpu_time, peak_rss: ended.append(name))
+    try:
+        with pytest.raises(Exception):
+            get_paper_ecg(input_file=str(tmp_path / 'r1.dat'), header_file=str(tmp_path / 'r1.hea'), output_directory=str(tmp_path),
+                          seed=0, add_dc_pulse=None, add_bw=None, show_grid=None, add_print=None, configs=read_config_file('config.yaml'))
+    finally:
+        remove_stage_hooks(hooks)
+    assert ended == ['load']
+    assert profiling.get_stage_stack() == []
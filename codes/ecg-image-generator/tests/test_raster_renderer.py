@@ -0,0 +1,42 @@
+import os
+import json
+import numpy as np
+import pytest
+from PIL import Image
+from gen_ecg_images_from_data_batch import get_parser, run
+from output_sinks import get_box_corners
+
+#Largest mean absolute difference of the images in grey levels, and of the bounding boxes and plotted pixels in pixels
+IMAGE_TOLERANCE = 2.0
+BOX_TOLERANCE = 2.0
+PIXEL_TOLERANCE = 0.01
+
+def generate(input_directory, output_directory, renderer, resolution):
+    args = get_parser().parse_args(['-i', str(input_directory), '-o', str(output_directory), '-se', '10', '-r', str(resolution),
+                                    '--store_config', '2', '--lead_bbox', '--lead_name_bbox', '--renderer', renderer])
+    return run(args)
+
+def read_image(output_directory, name):
+    image = np.asarray(Image.open(os.path.join(output_directory, name + '.png')).convert('RGB'), dtype=np.int16)
+    with open(os.path.join(output_directory, name + '.json'), 'r') as f:
+        return image, json.load(f)['leads']
+
+@pytest.mark.parametrize('resolution', [100, 150, 200, 250, 300])
+def test_raster_renderer_matches_matplotlib(tmp_path, make_record, resolution):
+    make_record(tmp_path / 'input', 'r1')
+    assert generate(tmp_path / 'input', tmp_path / 'matplotlib', 'matplotlib', resolution) == 1
+    assert generate(tmp_path / 'input', tmp_path / 'raster', 'raster', resolution) == 1
+
+    reference, reference_leads = read_image(tmp_path / 'matplotlib', 'r1-0')
+    image, leads = read_image(tmp_path / 'raster', 'r1-0')
+    assert image.shape == reference.shape
+    assert np.abs(image - reference).mean() <= IMAGE_TOLERANCE
+
+    assert [lead['lead_name'] for lead in leads] == [lead['lead_name'] for lead in reference_leads]
+    for lead, reference_lead in zip(leads, reference_leads):
+        assert sorted(lead.keys()) == sorted(reference_lead.keys())
+        for key in ('lead_bounding_box', 'text_bounding_box'):
+            assert np.abs(get_box_corners(lead, key) - get_box_corners(reference_lead, key)).max() <= BOX_TOLERANCE
+        pixels, reference_pixels = np.array(lead['plotted_pixels']), np.array(reference_lead['plotted_pixels'])
+        assert pixels.shape == reference_pixels.shape
+        assert np.abs(pixels - reference_pixels).max() <= PIXEL_TOLERANCE
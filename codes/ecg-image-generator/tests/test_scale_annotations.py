@@ -0,0 +1,62 @@
+import copy
+import numpy as np
+from helper_functions import scale_annotations
+
+def get_annotations():
+    return {
+        'width': 2200,
+        'height': 1700,
+        'x_grid': 39.37,
+        'y_grid': 39.37,
+        'resolution': 200,
+        'leads': [
+            {
+                'lead_name': 'I',
+                'start_sample': 0,
+                'end_sample': 250,
+                'lead_bounding_box': {'0': [301.0, 119.0], '1': [301.0, 611.0], '2': [455.0, 611.0], '3': [455.0, 119.0]},
+                'text_bounding_box': {'0': [462.0, 121.0], '1': [462.0, 131.0], '2': [481.0, 131.0], '3': [481.0, 121.0]},
+                'plotted_pixels': [[380.25, 120.5], [379.11, 121.47], [377.0, 123.0]],
+            },
+            {
+                'lead_name': 'II',
+                'start_sample': 250,
+                'end_sample': 500,
+                'lead_bounding_box': {'0': [301.0, 611.0], '1': [301.0, 1103.0], '2': [455.0, 1103.0], '3': [455.0, 611.0]},
+                'plotted_pixels': None,
+            },
+        ],
+    }
+
+def test_annotations_are_scaled_from_200_to_100_dpi():
+    annotations = get_annotations()
+    scaled = scale_annotations(annotations, 0.5, 0.5)
+
+    assert scaled['width'] == 1100 and scaled['height'] == 850
+    assert scaled['x_grid'] == 19.685 and scaled['y_grid'] == 19.685
+    #Values that are not pixel coordinates are copied
+    assert scaled['resolution'] == 200
+    assert [lead['lead_name'] for lead in scaled['leads']] == ['I', 'II']
+    assert [(lead['start_sample'], lead['end_sample']) for lead in scaled['leads']] == [(0, 250), (250, 500)]
+
+    first, second = scaled['leads']
+    assert first['lead_bounding_box'] == {'0': [150.5, 59.5], '1': [150.5, 305.5], '2': [227.5, 305.5], '3': [227.5, 59.5]}
+    assert first['text_bounding_box'] == {'0': [231.0, 60.5], '1': [231.0, 65.5], '2': [240.5, 65.5], '3': [240.5, 60.5]}
+    np.testing.assert_array_equal(first['plotted_pixels'], [[190.12, 60.25], [189.56, 60.74], [188.5, 61.5]])
+    assert second['lead_bounding_box'] == {'0': [150.5, 305.5], '1': [150.5, 551.5], '2': [227.5, 551.5], '3': [227.5, 305.5]}
+    assert 'text_bounding_box' not in second
+    assert second['plotted_pixels'] is None
+
+def test_annotations_are_scaled_along_each_axis():
+    scaled = scale_annotations(get_annotations(), 0.5, 0.25)
+    assert scaled['width'] == 1100 and scaled['height'] == 425
+    assert scaled['leads'][0]['lead_bounding_box']['1'] == [75.25, 305.5]
+    np.testing.assert_array_equal(scaled['leads'][0]['plotted_pixels'][0], [95.06, 60.25])
+
+def test_scaling_does_not_modify_the_annotations():
+    annotations = get_annotations()
+    scale_annotations(annotations, 0.5, 0.5)
+    assert annotations == get_annotations()
+
+def test_annotations_without_leads_are_scaled():
+    assert scale_annotations({'width': 2200, 'height': 1700}, 0.5, 0.5) == {'width': 1100, 'height': 850}
@@ -0,0 +1,61 @@
+import os
+from helper_functions import read_config_file
+from HandwrittenText.generate import get_medical_entities, load_handwriting_model
+from CreasesWrinkles.creases import read_texture, texture_as_float
+from output_writer import OutputWriter
+from output_sinks import FileSink
+from grid_cache import GridBackgroundCache
+from figure_pool import PageFigurePool
+
+class WorkerContext:
+    """Assets shared by every record generated in one process
+
+    The batch runner creates a single context per process and passes it to each
+    stage, so that the config file, fonts, wrinkle textures and the handwriting
+    model are loaded once instead of once per record. Heavy assets are loaded on
+    first use only. The context also owns the writer of the generated outputs and
+    the sink they are written to, one file per output unless replaced, the
+    matplotlib figures reused across pages and the cache of rendered grid
+    backgrounds when one is enabled.
+
+    Args:
+        config_file (str): Complete path to the config file
+        writer_threads (int): Number of background threads writing the outputs, 0 writes synchronously
+        grid_cache_mb (int): Memory budget of the grid background cache in MB, 0 disables the cache
+    """
+    def __init__(self, config_file, writer_threads=0, grid_cache_mb=0):
+        self.configs = read_config_file(config_file)
+        self.fonts = os.listdir('Fonts')
+        self.wrinkles_directory = os.path.join('CreasesWrinkles', 'wrinkles-dataset')
+        self.wrinkle_files = os.listdir(self.wrinkles_directory)
+        self._wrinkle_textures = dict()
+        self._medical_entities = dict()
+        self._handwriting_model = None
+        self.writer = OutputWriter(writer_threads)
+        self.sink = FileSink()
+        self.figure_pool = PageFigurePool()
+        self.grid_cache = GridBackgroundCache(grid_cache_mb*1024*1024) if grid_cache_mb > 0 else None
+
+    def get_wrinkle_texture(self, name):
+        if name not in self._wrinkle_textures:
+            self._wrinkle_textures[name] = read_texture(os.path.join(self.wrinkles_directory, name))
+        #Textures are kept as their 8-bit pixels, 8 times smaller than the float image quilted for every page
+        return texture_as_float(self._wrinkle_textures[name])
+
+    def get_medical_entities(self, link):
+        if link not in self._medical_entities:
+            self._medical_entities[link] = get_medical_entities(link)
+        return self._medical_entities[link]
+
+    @property
+    def handwriting_model(self):
+        if self._handwriting_model is None:
+            self._handwriting_model = load_handwriting_model()
+        return self._handwriting_model
+
+    def close(self):
+        self.writer.close()
+        self.sink.close()
+        if self._handwriting_model is not None:
+            self._handwriting_model[0].close()
+            self._handwriting_model = None